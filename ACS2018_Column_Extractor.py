@@ -1,52 +1,149 @@
 '''
 Code to extract and aggregate select columns from American Community Survey Summary FTP download.
-Code written specifically for 2018 Block Group Level ACS Dataset.
+Code written specifically for 2018 Block Group Level ACS Dataset. Other states and
+vintages of the 5-year Block Group Level ACS Dataset can be extracted by passing their
+`state` and `year`. Run `run_ACS_extractions` to extract many of them in parallel.
 '''
 
 import os
+import json
+import time
+import shutil
 import pandas as pd
 import numpy as np
+import scipy.sparse
+from concurrent.futures import ProcessPoolExecutor
+from mylib.geoid import bg_geoid
+from mylib.apportion import apportion_ct_to_bg
+from mylib.runstats import RunReport, instrumented, stage
 
 # Set the folder where the ACS summary data and template files are stored
 ACS_FOLDER = r"D:\Wejo Project\Data\GIS\ACS TX 2018"
 
-def generate_ACS2018_description(acs_folder):
-    ''' Compiles variable names from all the files in the template folder.
+# Identifier columns at the start of every sequence file
+ACS_ID_COLUMNS = ["FILEID", "FILETYPE", "STUSAB", "CHARITER", "SEQUENCE", "LOGRECNO"]
+
+# Variables whose '.' (no data) entries are read as 0 rather than np.nan. The
+# aggregate number of vehicles is '.' in block groups with no households.
+ZERO_IF_NO_DATA = ["B25046_001"]
+
+# Names used by the Census Bureau for the states in the summary file folders,
+# eg. "Texas_Tracts_Block_Groups_Only"
+STATE_NAMES = {"al": "Alabama", "ak": "Alaska", "az": "Arizona", "ar": "Arkansas", "ca": "California",
+               "co": "Colorado", "ct": "Connecticut", "de": "Delaware", "dc": "DistrictOfColumbia",
+               "fl": "Florida", "ga": "Georgia", "hi": "Hawaii", "id": "Idaho", "il": "Illinois",
+               "in": "Indiana", "ia": "Iowa", "ks": "Kansas", "ky": "Kentucky", "la": "Louisiana",
+               "me": "Maine", "md": "Maryland", "ma": "Massachusetts", "mi": "Michigan", "mn": "Minnesota",
+               "ms": "Mississippi", "mo": "Missouri", "mt": "Montana", "ne": "Nebraska", "nv": "Nevada",
+               "nh": "NewHampshire", "nj": "NewJersey", "nm": "NewMexico", "ny": "NewYork",
+               "nc": "NorthCarolina", "nd": "NorthDakota", "oh": "Ohio", "ok": "Oklahoma", "or": "Oregon",
+               "pa": "Pennsylvania", "pr": "PuertoRico", "ri": "RhodeIsland", "sc": "SouthCarolina",
+               "sd": "SouthDakota", "tn": "Tennessee", "tx": "Texas", "ut": "Utah", "vt": "Vermont",
+               "va": "Virginia", "wa": "Washington", "wv": "WestVirginia", "wi": "Wisconsin", "wy": "Wyoming"}
+
+# Template indices already loaded in this process, by template folder
+_TEMPLATE_INDICES = dict()
+
+def _data_path(acs_folder, file, state):
+    ''' Path of a summary file of `state` inside `acs_folder`. '''
+    return os.path.join(acs_folder, "%s_Tracts_Block_Groups_Only" % STATE_NAMES[state], file)
+
+def _store_done_path(store_folder, state):
+    ''' Path of the file marking that the conversion of `state` into the store is complete. '''
+    return os.path.join(store_folder, "_DONE_state=%s" % state)
+
+@instrumented()
+def load_ACS2018_template_index(acs_folder, year=2018):
+    ''' Loads the index of all variables in the template files.
+
+    Reading the Excel templates is slow, so the index is saved as 
+    "ACS2018_template_index.parquet" in `acs_folder` the first time it is
+    built, along with the modification times of the templates in
+    "ACS2018_template_index.json". The index is rebuilt only when the 
+    templates have been modified, added or removed. Once loaded, the index
+    is also kept in memory for later calls in the same process.
 
     Parameters
     ----------
     acs_folder : str
         Path of folder containing ACS data template files. The folder 
         "2018_5yr_Summary_FileTemplates" is expected to be inside this folder.
+    year : int, optional
+        Vintage of the ACS data. The file names above use this year.
 
     Returns
     -------
-    variable_descriptions : pd.DataFrame
-        DataFrame with two columns.
+    template_index : pd.DataFrame
+        DataFrame with three columns.
         index - Variable name
-        Column 1 - file_index - Index of file containing the variable
-        Column 2 - description - Description of the variable
+        Column 1 - file_index - Index of file containing the variable. The
+            columns of the geography file have a file_index of 0.
+        Column 2 - column_position - Position of the variable's column in 
+            the file
+        Column 3 - description - Description of the variable
 
     '''
     
-    template_folder = os.path.join(acs_folder, "2018_5yr_Summary_FileTemplates")
+    template_folder = os.path.join(acs_folder, "%d_5yr_Summary_FileTemplates" % year)
     template_files = os.listdir(template_folder)
     template_files = [ (int(file.split(".")[0][3:]), file) for file in template_files if file[0:3] == "seq"]
     template_files.sort()
+    template_files.insert(0, (0, "%d_SFGeoFileTemplate.xlsx" % year))
+    
+    index_path = os.path.join(acs_folder, "ACS%d_template_index.parquet" % year)
+    mtimes_path = os.path.join(acs_folder, "ACS%d_template_index.json" % year)
+    mtimes = {file: os.stat(os.path.join(template_folder, file)).st_mtime_ns for _, file in template_files}
+    if template_folder in _TEMPLATE_INDICES and _TEMPLATE_INDICES[template_folder][0] == mtimes:
+        return _TEMPLATE_INDICES[template_folder][1]
+    if os.path.exists(index_path) and os.path.exists(mtimes_path):
+        with open(mtimes_path) as f:
+            if json.load(f) == mtimes:
+                _TEMPLATE_INDICES[template_folder] = (mtimes, pd.read_parquet(index_path))
+                return _TEMPLATE_INDICES[template_folder][1]
     
     all_templates = list()
     for index, file in template_files:
-        template = pd.read_excel(os.path.join(template_folder, file))
-        template = template.drop(["FILEID", "FILETYPE", "STUSAB", "CHARITER", "SEQUENCE", "LOGRECNO"], axis=1)
-        all_templates.append(pd.DataFrame({"file_index": index, "description": template.iloc[0,]}, index=template.columns))
+        template = pd.read_excel(os.path.join(template_folder, file), nrows=1)
+        descriptions = template.iloc[0,] if template.shape[0] > 0 else pd.Series("", index=template.columns)
+        template_index = pd.DataFrame({"file_index": index, "column_position": np.arange(template.shape[1]),
+                                       "description": descriptions.astype(str)}, index=template.columns)
+        if index > 0:
+            template_index = template_index.drop(ACS_ID_COLUMNS, axis=0)
+        all_templates.append(template_index)
     
-    variable_descriptions = pd.concat(all_templates)
-    variable_descriptions.index.name = 'variable'
-    return variable_descriptions
+    template_index = pd.concat(all_templates)
+    template_index.index.name = 'variable'
+    template_index.to_parquet(index_path)
+    with open(mtimes_path, "w") as f:
+        json.dump(mtimes, f)
+    _TEMPLATE_INDICES[template_folder] = (mtimes, template_index)
+    return template_index
+
+@instrumented()
+def generate_ACS2018_description(acs_folder, year=2018):
+    ''' Compiles variable names from all the files in the template folder.
 
-# Compiling the ACS file templates into single DataFrame and saving it.
-variable_descriptions = generate_ACS2018_description(ACS_FOLDER)
-variable_descriptions.to_csv(os.path.join(ACS_FOLDER, "ACS_variable_descriptions.csv"))
+    Parameters
+    ----------
+    acs_folder : str
+        Path of folder containing ACS data template files. The folder 
+        "2018_5yr_Summary_FileTemplates" is expected to be inside this folder.
+    year : int, optional
+        Vintage of the ACS data.
+
+    Returns
+    -------
+    variable_descriptions : pd.DataFrame
+        DataFrame with two columns.
+        index - Variable name
+        Column 1 - file_index - Index of file containing the variable
+        Column 2 - description - Description of the variable
+
+    '''
+    
+    template_index = load_ACS2018_template_index(acs_folder, year)
+    variable_descriptions = template_index.loc[template_index["file_index"] > 0, ["file_index", "description"]]
+    return variable_descriptions
 
 ''' 
 compilation tells how the columns in the ACS files are to be aggregated.
@@ -163,9 +260,203 @@ compilation = [ ("population"         , ["B01001_001"]),
                 
                 ]
 
-def compile_ACS2018_dat(compilation, acs_folder):
+@instrumented()
+def read_ACS2018_sequence(acs_folder, file_index, acs_vars, chunksize=100000, template_index=None, state="tx", year=2018):
+    ''' Reads selected variables from an ACS summary sequence file.
+
+    Only `LOGRECNO` and the columns in `acs_vars` are parsed. The file is
+    read in chunks of `chunksize` rows with explicit dtypes, so that entries
+    of '.' (no data) are read as np.nan, or as 0 for the variables in
+    `ZERO_IF_NO_DATA`. Empty entries are read as np.nan.
+
+    Parameters
+    ----------
+    acs_folder : str
+        Path of folder containing ACS data template files. The folder 
+        "2018_5yr_Summary_FileTemplates" and the folder 
+        "Texas_Tracts_Block_Groups_Only" are expected to be inside this folder.
+    file_index : int
+        Index of the sequence file.
+    acs_vars : list of str
+        Names of the ACS variables to read from the file.
+    chunksize : int, optional
+        Number of rows parsed at a time.
+    template_index : pd.DataFrame, optional
+        Output of `load_ACS2018_template_index`. Loaded if not given.
+    state : str, optional
+        Two letter abbreviation of the state. The "Texas" and "tx" in the
+        names of the folders and files above are for the state.
+    year : int, optional
+        Vintage of the ACS data. The "2018" in the names of the folders and
+        files above is for the year.
+
+    Returns
+    -------
+    acs_data : pd.DataFrame
+        DataFrame with `LOGRECNO` and `acs_vars` columns.
+
+    '''
+    
+    acs_vars = list(dict.fromkeys(acs_vars))
+    if template_index is None:
+        template_index = load_ACS2018_template_index(acs_folder, year)
+    columns = {ACS_ID_COLUMNS.index("LOGRECNO"): "LOGRECNO"}
+    columns.update(zip(template_index.loc[acs_vars, "column_position"], acs_vars))
+    dtypes = dict.fromkeys(columns, np.float64)
+    dtypes[ACS_ID_COLUMNS.index("LOGRECNO")] = np.int64
+    na_values = dict.fromkeys(columns, ["."])
+    zero_vars = [acs_var for acs_var in acs_vars if acs_var in ZERO_IF_NO_DATA]
+    for position, acs_var in columns.items():
+        if acs_var in zero_vars:
+            dtypes[position] = str
+            na_values[position] = []
+    chunks = pd.read_csv(_data_path(acs_folder, "e%d5%s%04d000.txt" % (year, state, file_index), state),
+                         header=None, usecols=list(columns), dtype=dtypes, na_values=na_values,
+                         chunksize=chunksize)
+    acs_data = pd.concat(chunks, ignore_index=True).rename(columns=columns)
+    for acs_var in zero_vars:
+        acs_data[acs_var] = acs_data[acs_var].replace(".", "0").astype(np.float64)
+    return acs_data[["LOGRECNO"] + acs_vars]
+
+@instrumented()
+def read_ACS2018_geography(acs_folder, template_index=None, state="tx", year=2018):
+    ''' Reads the geography file of the ACS summary data.
+
+    Parameters
+    ----------
+    acs_folder : str
+        Path of folder containing ACS data template files. The folder 
+        "Texas_Tracts_Block_Groups_Only" is expected to be inside this folder.
+    template_index : pd.DataFrame, optional
+        Output of `load_ACS2018_template_index`. Loaded if not given.
+    state : str, optional
+        Two letter abbreviation of the state. The "Texas" and "tx" in the
+        names of the folders and files above are for the state.
+    year : int, optional
+        Vintage of the ACS data. The "2018" in the names of the folders and
+        files above is for the year.
+
+    Returns
+    -------
+    row_dat : pd.DataFrame
+        One row for each LOGRECNO with the columns of the geography file.
+
+    '''
+    
+    if template_index is None:
+        template_index = load_ACS2018_template_index(acs_folder, year)
+    headers = template_index.index[template_index["file_index"] == 0]
+    return pd.read_csv(_data_path(acs_folder, "g%d5%s.csv" % (year, state), state), names=headers, encoding='latin-1')
+
+@instrumented()
+def convert_ACS2018_to_parquet(acs_folder, store_folder, state="tx", year=2018):
+    ''' Converts the ACS summary files into a columnar Parquet store.
+
+    The geography file is saved in the folder "geography" and each sequence
+    file in a folder "seqNNNN" inside `store_folder`. Each of these is a 
+    Parquet dataset partitioned by state and, for the sequence files, by the
+    summary level (SUMLEVEL) of the rows. The estimates are stored as
+    float64 as read by `read_ACS2018_sequence`, with '.' (no data) as null
+    or 0. Converting another state into the
+    same `store_folder` adds its partitions; converting a state again
+    replaces its partitions. A file "_DONE_state=ss" is written in
+    `store_folder` once all the files of the state are converted, so that a
+    conversion interrupted partway is done again on the next run.
+
+    Parameters
+    ----------
+    acs_folder : str
+        Path of folder containing ACS data template files. The folder 
+        "2018_5yr_Summary_FileTemplates" and the folder 
+        "Texas_Tracts_Block_Groups_Only" are expected to be inside this folder.
+    store_folder : str
+        Path of folder where the Parquet store is saved.
+    state : str, optional
+        Two letter abbreviation of the state. The "Texas" and "tx" in the
+        names of the folders and files above are for the state.
+    year : int, optional
+        Vintage of the ACS data. The "2018" in the names of the folders and
+        files above is for the year.
+
+    Returns
+    -------
+    None.
+
+    '''
+    
+    template_index = load_ACS2018_template_index(acs_folder, year)
+    done_path = _store_done_path(store_folder, state)
+    if os.path.exists(done_path):
+        os.remove(done_path)
+    
+    def write_dataset(data, dataset, partition_cols):
+        shutil.rmtree(os.path.join(store_folder, dataset, "state=%s" % state), ignore_errors=True)
+        data.to_parquet(os.path.join(store_folder, dataset), partition_cols=partition_cols, index=False)
+    
+    row_dat = read_ACS2018_geography(acs_folder, template_index, state, year)
+    text_columns = row_dat.columns[row_dat.dtypes == object]
+    row_dat[text_columns] = row_dat[text_columns].astype("string")
+    row_dat["state"] = state
+    write_dataset(row_dat.sort_values(["SUMLEVEL", "LOGRECNO"]), "geography", ["state"])
+    sumlevels = row_dat.set_index("LOGRECNO")["SUMLEVEL"]
+    
+    variables = template_index.loc[template_index["file_index"] > 0]
+    for file_index, file_variables in variables.groupby("file_index"):
+        acs_data = read_ACS2018_sequence(acs_folder, file_index, list(file_variables.index), template_index=template_index,
+                                         state=state, year=year)
+        acs_data["state"] = state
+        acs_data["sumlevel"] = acs_data["LOGRECNO"].map(sumlevels)
+        write_dataset(acs_data, "seq%04d" % file_index, ["state", "sumlevel"])
+    
+    with open(done_path, "w") as done_file:
+        done_file.write("%d sequence files\n" % variables["file_index"].nunique())
+
+@instrumented()
+def read_ACS2018_store(store_folder, dataset, columns, sumlevels=(140, 150), state="tx"):
+    ''' Reads columns from the Parquet store of the ACS summary data.
+
+    Only the requested columns are read, and only for the partitions of
+    `state` and the summary levels in `sumlevels`.
+
+    Parameters
+    ----------
+    store_folder : str
+        Path of folder with the store created by `convert_ACS2018_to_parquet`.
+    dataset : str or int
+        "geography", or the index of a sequence file.
+    columns : list of str
+        Names of the columns to read.
+    sumlevels : tuple of int, optional
+        Summary levels to read. 140 is county-tract and 150 is block group.
+    state : str, optional
+        Two letter abbreviation of the state to read.
+
+    Returns
+    -------
+    pd.DataFrame
+        DataFrame with `columns`.
+
+    '''
+    
+    if dataset == "geography":
+        filters = [("state", "=", state), ("SUMLEVEL", "in", list(sumlevels))]
+    else:
+        dataset = "seq%04d" % dataset
+        filters = [("state", "=", state), ("sumlevel", "in", list(sumlevels))]
+    return pd.read_parquet(os.path.join(store_folder, dataset), columns=list(dict.fromkeys(columns)), filters=filters)
+
+@instrumented()
+def compile_ACS2018_dat(compilation, acs_folder, store_folder=None, state="tx", year=2018):
     ''' Generate a new dataframe from the ACS dataset based on compilation.
 
+    All the ACS variables used in `compilation` are read, one sequence file
+    at a time and only for the columns that are needed, and aligned on
+    LOGRECNO into a single matrix. Every entry of `compilation` is then 
+    computed at once as the product of this matrix with a sparse selection
+    matrix, so the ACS variables of an entry may come from different files.
+    As before, the new column is missing if any of its ACS variables are
+    missing.
+
     Parameters
     ----------
     compilation : list of tuples
@@ -174,13 +465,21 @@ def compile_ACS2018_dat(compilation, acs_folder):
         Path of folder containing ACS data template files. The folder 
         "2018_5yr_Summary_FileTemplates" and the folder 
         "Texas_Tracts_Block_Groups_Only" are expected to be inside this folder.
+    store_folder : str, optional
+        Path of folder with the store created by `convert_ACS2018_to_parquet`.
+        If given, the ACS variables are read from the store instead of the
+        summary files.
+    state : str, optional
+        Two letter abbreviation of the state. The "Texas" and "tx" in the
+        names of the folders and files above are for the state.
+    year : int, optional
+        Vintage of the ACS data. The "2018" in the names of the folders and
+        files above is for the year.
 
     Raises
     ------
     Exception
-        New columns may be formed only by aggregating ACS columns in the same
-        ACS file. If the columns that need to be added come from different 
-        files, an exception will be raised.
+        If LOGRECNO is repeated in a sequence file.
 
     Returns
     -------
@@ -189,40 +488,57 @@ def compile_ACS2018_dat(compilation, acs_folder):
 
     '''
     
-    variable_descriptions = generate_ACS2018_description(acs_folder)
-    template_folder = os.path.join(acs_folder, "2018_5yr_Summary_FileTemplates")
-    file_index = 1
-    template = pd.read_excel(os.path.join(template_folder, "seq%d.xlsx" % file_index))
-    acs_data = pd.read_csv(os.path.join(acs_folder, "Texas_Tracts_Block_Groups_Only", "e20185tx%04d000.txt" % file_index), names=template.columns)
-    acs_compile_dat = pd.DataFrame(acs_data["LOGRECNO"])
-
-    for my_var, acs_vars in compilation:
-        
-        file_index = variable_descriptions.loc[acs_vars, "file_index"]
-        if sum(~file_index.duplicated()) != 1:
-            raise Exception("Current code does not allow calculating a variable by summing ACS variables from multiple files")
+    template_index = load_ACS2018_template_index(acs_folder, year)
+    variable_descriptions = template_index.loc[template_index["file_index"] > 0]
+    
+    all_acs_vars = pd.Index(list(dict.fromkeys(acs_var for _, acs_vars in compilation for acs_var in acs_vars)))
+    file_indices = variable_descriptions.loc[all_acs_vars, "file_index"]
+    
+    all_acs_data = list()
+    for file_index, file_vars in file_indices.groupby(file_indices):
+        if store_folder is not None:
+            acs_data = read_ACS2018_store(store_folder, int(file_index), ["LOGRECNO"] + list(file_vars.index), state=state)
         else:
-            file_index = int(file_index[0])
-            
-        template = pd.read_excel(os.path.join(template_folder, "seq%d.xlsx" % file_index))
-        acs_data = pd.read_csv(os.path.join(acs_folder, "Texas_Tracts_Block_Groups_Only", "e20185tx%04d000.txt" % file_index), names=template.columns)
-        acs_data[my_var] = acs_data[acs_vars].sum(axis=1, skipna=False)
-        acs_compile_dat = acs_compile_dat.merge(acs_data[["LOGRECNO", my_var]], on = "LOGRECNO", validate="1:1")
-        
+            acs_data = read_ACS2018_sequence(acs_folder, int(file_index), list(file_vars.index), template_index=template_index,
+                                             state=state, year=year)
+        acs_data = acs_data.set_index("LOGRECNO")
+        if not acs_data.index.is_unique:
+            raise Exception(f"LOGRECNO is repeated in sequence file {file_index}")
+        all_acs_data.append(acs_data)
+    
+    # Aligning all the sequence files on the LOGRECNOs present in all of them
+    logrecnos = all_acs_data[0].index
+    for acs_data in all_acs_data[1:]:
+        logrecnos = logrecnos.intersection(acs_data.index, sort=False)
+    acs_matrix = np.empty((len(logrecnos), len(all_acs_vars)))
+    for acs_data in all_acs_data:
+        acs_matrix[:, all_acs_vars.get_indexer(acs_data.columns)] = acs_data.reindex(logrecnos).to_numpy(dtype=np.float64)
+    
+    # selection[i, j] is 1 if the i-th ACS variable is added to form the j-th new column
+    rows = np.concatenate([all_acs_vars.get_indexer(acs_vars) for _, acs_vars in compilation])
+    cols = np.repeat(np.arange(len(compilation)), [len(acs_vars) for _, acs_vars in compilation])
+    selection = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(all_acs_vars), len(compilation)))
+    
+    # The sparse product only touches the selected variables, so missing values
+    # propagate only into the new columns that use them
+    compiled = (selection.T @ acs_matrix.T).T
+    
+    acs_compile_dat = pd.DataFrame(compiled, columns=[my_var for my_var, _ in compilation])
+    acs_compile_dat.insert(0, "LOGRECNO", logrecnos.to_numpy())
     return(acs_compile_dat)
 
-# Extracted columns from ACS dataset.
-acs_compile_dat = compile_ACS2018_dat(compilation, ACS_FOLDER)
-
+@instrumented()
 def fix_nonnumeric_cols(acs_compile_dat):
     ''' Fixes non-numeric entries in some of the columns.
     
-    The 'vehicles', 'median_income', and 'median_age' does not have the
+    The 'vehicles', 'median_income', and 'median_age' may not have the
     expected float64 format. This is because of the presence of '.' as some of
     the column entries - typically occurs when there are no households in that
     block group. This function converts those entries into 0 for vehickles and
     np.nan for the other columns. Then all these columns are cast into the 
-    np.float64 datatype. This operation is NOT inplace.
+    np.float64 datatype. Columns read with `read_ACS2018_sequence` or from
+    the Parquet store are already converted in the same way and are left as
+    they are. This operation is NOT inplace.
 
     Parameters
     ----------
@@ -240,19 +556,16 @@ def fix_nonnumeric_cols(acs_compile_dat):
         if dtype.kind not in 'biufc': print(var, 'is not numeric.')
     
     acs_compile_dat = acs_compile_dat.copy()
-    print('Fixing dtype of vehicles.')
-    acs_compile_dat['vehicles'] = acs_compile_dat['vehicles'].str.replace("^.$", "0").astype(np.float64)
-    print('Fixing dtype of median_income')
-    acs_compile_dat['median_income'] = acs_compile_dat['median_income'].str.replace("^.$", "nan").astype(np.float64)
-    print('Fixing dtype of median_age.')
-    acs_compile_dat['median_age'] = acs_compile_dat['median_age'].str.replace("^.$", "nan").astype(np.float64)
+    for var, fill_value in [('vehicles', "0"), ('median_income', "nan"), ('median_age', "nan")]:
+        if acs_compile_dat[var].dtype.kind in 'biufc':
+            continue
+        print(f'Fixing dtype of {var}.')
+        acs_compile_dat[var] = acs_compile_dat[var].replace(".", fill_value).astype(np.float64)
     
     return acs_compile_dat
 
-# Fixing the 'vehicles', 'median_income', and 'median_age' columns to be float64.
-acs_compile_dat = fix_nonnumeric_cols(acs_compile_dat)
-
-def generate_bg_ct_relation(acs_folder):
+@instrumented()
+def generate_bg_ct_relation(acs_folder, store_folder=None, state="tx", year=2018):
     ''' Generate table for mapping between block groups and county-tract.
     
     The key values (LOGRECNO) used in the ACS dataset are used as identifiers
@@ -263,31 +576,44 @@ def generate_bg_ct_relation(acs_folder):
     acs_folder : str
         Path of folder containing ACS data template files. The folder 
         "Texas_Tracts_Block_Groups_Only" is expected to be inside this folder.
+    store_folder : str, optional
+        Path of folder with the store created by `convert_ACS2018_to_parquet`.
+        If given, the geography is read from the store.
+    state : str, optional
+        Two letter abbreviation of the state. The "Texas" and "tx" in the
+        names of the folders and files above are for the state.
+    year : int, optional
+        Vintage of the ACS data. The "2018" in the names of the folders and
+        files above is for the year.
 
     Returns
     -------
     matched_logrecnos: pd.DataFrame
         A dataframe where each row represents a block group and has columns,
         LOGRECNO - key value for block group in the ACS dataset.
+        STATE - FIPS code of the state where the block group lies.
         COUNTY - ID of county where the block group lies.
         TRACT - ID of census tract where the block group lies.
         CTLOGRECNO - key value for the county-tract where the block group lies
             in the ACS dataset.
 
     '''
-    headers = pd.read_excel(os.path.join(acs_folder, "2018_5yr_Summary_FileTemplates", "2018_SFGeoFileTemplate.xlsx"))
-    row_dat = pd.read_csv(os.path.join(acs_folder, "Texas_Tracts_Block_Groups_Only", "g20185tx.csv"), names=headers.columns, encoding='latin-1')
-    bg_rows = row_dat.loc[row_dat['SUMLEVEL'] == 150, ['LOGRECNO', 'COUNTY', 'TRACT', 'BLKGRP']]
+    if store_folder is not None:
+        row_dat = read_ACS2018_store(store_folder, "geography", ['LOGRECNO', 'SUMLEVEL', 'STATE', 'COUNTY', 'TRACT', 'BLKGRP'], state=state)
+    else:
+        row_dat = read_ACS2018_geography(acs_folder, state=state, year=year)
+    bg_rows = row_dat.loc[row_dat['SUMLEVEL'] == 150, ['LOGRECNO', 'STATE', 'COUNTY', 'TRACT', 'BLKGRP']]
     ct_rows = row_dat.loc[row_dat['SUMLEVEL'] == 140, ['LOGRECNO', 'COUNTY', 'TRACT']]
     ct_rows = ct_rows.rename({'LOGRECNO': 'CTLOGRECNO'}, axis=1)
     matched_logrecnos = bg_rows.merge(ct_rows, on=['COUNTY', 'TRACT'])
     return(matched_logrecnos)
 
-def split_bg_ct_dat(acs_compile_dat, acs_folder):
+@instrumented()
+def split_bg_ct_dat(acs_compile_dat, acs_folder, store_folder=None, state="tx", year=2018):
     ''' Splits compiled ACS dataset into block-group and county-tract datasets.
     
-    The county and tract IDs are also added as columns to the block-group
-    dataframe.
+    The state, county and tract IDs and the GEOID of the block groups are
+    also added as columns to the block-group dataframe.
     
     Parameters
     ----------
@@ -296,6 +622,8 @@ def split_bg_ct_dat(acs_compile_dat, acs_folder):
     acs_folder : str
         Path of folder containing ACS data template files. The folder 
         "Texas_Tracts_Block_Groups_Only" is expected to be inside this folder.
+    store_folder, state, year : optional
+        See `generate_bg_ct_relation`.
 
     Returns
     -------
@@ -305,14 +633,13 @@ def split_bg_ct_dat(acs_compile_dat, acs_folder):
         Subset of `acs_compile_dat` with county-tract data.
 
     '''
-    bg_ct_match_dat = generate_bg_ct_relation(acs_folder)
+    bg_ct_match_dat = generate_bg_ct_relation(acs_folder, store_folder, state, year)
     acs_bg_dat = acs_compile_dat.loc[acs_compile_dat['LOGRECNO'].isin(bg_ct_match_dat['LOGRECNO']),:]
     acs_ct_dat = acs_compile_dat.loc[acs_compile_dat['LOGRECNO'].isin(bg_ct_match_dat['CTLOGRECNO']),:]
     acs_bg_dat = acs_bg_dat.merge(bg_ct_match_dat, on=['LOGRECNO'])
+    acs_bg_dat['GEOID'] = bg_geoid(acs_bg_dat['COUNTY'], acs_bg_dat['TRACT'], acs_bg_dat['BLKGRP'], state=acs_bg_dat['STATE'])
     return acs_bg_dat, acs_ct_dat
 
-acs_bg_dat, acs_ct_dat = split_bg_ct_dat(acs_compile_dat, ACS_FOLDER)
-
 def disintegrate_ct_to_bg(acs_ct_dat, acs_bg_dat, disintegrate_columns, based_on):
     '''Splits the county-tract data into overlapping block-groups.
     
@@ -352,31 +679,10 @@ def disintegrate_ct_to_bg(acs_ct_dat, acs_bg_dat, disintegrate_columns, based_on
         `acs_ct_dat`.
     '''
     
-    acs_ct_dat = acs_ct_dat.set_index('LOGRECNO')
-    acs_bg_dat = acs_bg_dat.copy()
-    
-    if based_on is not None: # Split the census tract value between block groups based on 'based_on'
-        if abs((acs_bg_dat[based_on].sum() - acs_ct_dat[based_on].sum()) / acs_ct_dat[based_on].sum()) > .001:
-            raise Exception(f'{based_on} values not consistent across census tracts and block groups.\nTotal {based_on} across block groups = {acs_bg_dat[based_on].sum()} \nTotal {based_on} across census tracts = {acs_ct_dat[based_on].sum()}')
-        
-        with np.errstate(divide='ignore', invalid='ignore'): # Supress zero-division warning
-            fraction = np.array(acs_bg_dat[based_on]) / np.array(acs_ct_dat.loc[acs_bg_dat['CTLOGRECNO'], based_on])
-        fraction[acs_ct_dat.loc[acs_bg_dat['CTLOGRECNO'], based_on]==0] = 0
-        fraction = fraction.reshape((-1,1))
-        acs_bg_dat[disintegrate_columns] = (acs_ct_dat.loc[acs_bg_dat['CTLOGRECNO'], disintegrate_columns]*fraction).values
-    else: # based_on is None - Apply the census tract value to all component block groups
-        acs_bg_dat[disintegrate_columns] = acs_ct_dat.loc[acs_bg_dat['CTLOGRECNO'], disintegrate_columns].values
-    return acs_bg_dat
-
-# Splitting worker variables from county-tracts into block groups
-acs_bg_dat = disintegrate_ct_to_bg(acs_ct_dat, acs_bg_dat, 
-                                   disintegrate_columns=acs_compile_dat.filter(regex="^worker|^wk").columns, 
-                                   based_on='population')
-# Copying median_income of county-tracts into block groups.
-acs_bg_dat = disintegrate_ct_to_bg(acs_ct_dat, acs_bg_dat, 
-                                   disintegrate_columns=['median_income'], 
-                                   based_on=None)
+    with stage("apportion_ct_to_bg", rows=len(acs_bg_dat)):
+        return apportion_ct_to_bg(acs_ct_dat, acs_bg_dat, [(disintegrate_columns, based_on)])
 
+@instrumented()
 def impute_num_vehicles(acs_bg_dat):
     '''Imputing missing values in `vehicles` column.
     
@@ -411,8 +717,134 @@ def impute_num_vehicles(acs_bg_dat):
     acs_bg_dat.loc[acs_bg_dat['vehicles'].isna(), 'vehicles'] = my_vehicles[acs_bg_dat['vehicles'].isna()]
     return(acs_bg_dat)
 
-# Imputing missing values in vehicles column
-acs_bg_dat = impute_num_vehicles(acs_bg_dat)
+@instrumented()
+def extract_ACS_bg(acs_folder, state="tx", year=2018, compilation=compilation, store_folder=None, output_path=None):
+    ''' Extracts the block group dataset of a state and vintage.
+
+    Runs all the steps of this module: compiling the columns in 
+    `compilation`, splitting the block group and county-tract data,
+    apportioning the county-tract worker data into block groups and
+    imputing the number of vehicles. The summary files are converted into
+    the Parquet store on the first run.
+
+    Parameters
+    ----------
+    acs_folder : str
+        Path of folder containing ACS data template files. The folder 
+        "2018_5yr_Summary_FileTemplates" and the folder 
+        "Texas_Tracts_Block_Groups_Only" are expected to be inside this folder.
+    state : str, optional
+        Two letter abbreviation of the state. The "Texas" and "tx" in the
+        names of the folders and files above are for the state.
+    year : int, optional
+        Vintage of the ACS data. The "2018" in the names of the folders and
+        files above is for the year.
+    compilation : list of tuples, optional
+        Describes how the columns in ACS are to be aggregated.
+    store_folder : str, optional
+        Path of folder with the Parquet store of the summary files. Defaults
+        to the folder "ACS2018_parquet" inside `acs_folder`.
+    output_path : str, optional
+        If given, the block group dataset is saved here, as Parquet if the
+        path ends with ".parquet" and as CSV otherwise.
+
+    Returns
+    -------
+    acs_bg_dat : pd.DataFrame
+        Block group data.
+
+    '''
+    
+    # Converting the summary files into a Parquet store on the first run.
+    if store_folder is None:
+        store_folder = os.path.join(acs_folder, "ACS%d_parquet" % year)
+    if not os.path.exists(_store_done_path(store_folder, state)):
+        convert_ACS2018_to_parquet(acs_folder, store_folder, state, year)
+    
+    # Extracted columns from ACS dataset.
+    acs_compile_dat = compile_ACS2018_dat(compilation, acs_folder, store_folder, state, year)
+    
+    # Fixing the 'vehicles', 'median_income', and 'median_age' columns to be float64.
+    acs_compile_dat = fix_nonnumeric_cols(acs_compile_dat)
+    
+    acs_bg_dat, acs_ct_dat = split_bg_ct_dat(acs_compile_dat, acs_folder, store_folder, state, year)
+    
+    # Splitting worker variables from county-tracts into block groups and
+    # copying median_income of county-tracts into block groups.
+    with stage("apportion_ct_to_bg", rows=len(acs_bg_dat)):
+        acs_bg_dat = apportion_ct_to_bg(acs_ct_dat, acs_bg_dat, 
+                                        [(acs_compile_dat.filter(regex="^worker|^wk").columns, 'population'),
+                                         (['median_income'], None)])
+    
+    # Imputing missing values in vehicles column
+    acs_bg_dat = impute_num_vehicles(acs_bg_dat)
+    
+    if output_path is not None:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        if output_path.endswith(".parquet"):
+            acs_bg_dat.to_parquet(output_path, index=False)
+        else:
+            acs_bg_dat.to_csv(output_path, index=False)
+    return acs_bg_dat
+
+def _load_template_indices(template_folders):
+    ''' Loads the template indices once when a worker process starts. '''
+    for acs_folder, year in template_folders:
+        load_ACS2018_template_index(acs_folder, year)
+
+def _extract_ACS_job(acs_folder, state, year, output_folder, compilation):
+    ''' Runs `extract_ACS_bg` for one job of `run_ACS_extractions`. '''
+    output_path = os.path.join(output_folder, "year=%d" % year, "state=%s" % state, "ACS_bg_extract.parquet")
+    extract_ACS_bg(acs_folder, state, year, compilation, output_path=output_path)
+    return output_path
+
+def run_ACS_extractions(jobs, output_folder, n_jobs=None, compilation=compilation):
+    ''' Extracts the block group datasets of many states and vintages in parallel.
 
-# Saving extracted dataset.
-acs_bg_dat.to_csv(os.path.join(ACS_FOLDER, 'ACS_bg_extract.csv'), index=False)
+    Each job runs `extract_ACS_bg` in a pool of processes. The template
+    indices are built before the pool starts and loaded once in each of the
+    worker processes. The outputs are saved in `output_folder` as 
+    "year=YYYY/state=ss/ACS_bg_extract.parquet", so that all of them can be
+    read together with `pd.read_parquet(output_folder)`.
+
+    Parameters
+    ----------
+    jobs : list of tuples
+        (acs_folder, state, year) of each dataset to extract. See
+        `extract_ACS_bg`.
+    output_folder : str
+        Path of folder where the outputs are saved.
+    n_jobs : int, optional
+        Number of processes. Defaults to the number of CPUs.
+    compilation : list of tuples, optional
+        Describes how the columns in ACS are to be aggregated.
+
+    Returns
+    -------
+    output_paths : list of str
+        Path of the output of each job.
+
+    '''
+    
+    # Building the template indices here so that the workers only read them
+    template_folders = sorted(set((acs_folder, year) for acs_folder, _, year in jobs))
+    _load_template_indices(template_folders)
+    
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_load_template_indices, initargs=(template_folders,)) as executor:
+        futures = [executor.submit(_extract_ACS_job, acs_folder, state, year, output_folder, compilation)
+                   for acs_folder, state, year in jobs]
+        output_paths = [future.result() for future in futures]
+    return output_paths
+
+if __name__ == "__main__":
+    # Recording the time, memory and rows of each stage in a JSON report. Pass a
+    # profile_path to also save a cProfile dump of the run.
+    run_name = "ACS2018_Column_Extractor_%s" % time.strftime("%Y%m%d_%H%M%S")
+    with RunReport("ACS2018_Column_Extractor", report_path=os.path.join(ACS_FOLDER, "run_reports", run_name + ".json"),
+                   parameters={"state": "tx", "year": 2018}):
+        # Compiling the ACS file templates into single DataFrame and saving it.
+        variable_descriptions = generate_ACS2018_description(ACS_FOLDER)
+        variable_descriptions.to_csv(os.path.join(ACS_FOLDER, "ACS_variable_descriptions.csv"))
+        
+        # Extracting the Texas block group dataset and saving it.
+        acs_bg_dat = extract_ACS_bg(ACS_FOLDER, output_path=os.path.join(ACS_FOLDER, 'ACS_bg_extract.csv'))
@@ -1,3 +1,7 @@
+/* The columns derived from data below can instead be extracted in one pass while
+   loading the raw events with mylib/eventstream.py.
+   mylib/duckpipe.py runs the whole pipeline below on an embedded DuckDB database */
+
 /* Add new column to store event location as geometry */
 ALTER TABLE driver_data
 ADD COLUMN loc_geom geometry(Point, 4326);
@@ -10,7 +14,8 @@ SET loc_geom = ST_SetSRID(ST_MakePoint((data->'location'->>'longitude')::numeric
 ALTER TABLE driver_data
 ADD COLUMN bg_id VARCHAR;
 
-/* Finding matching block groups for all event locations */
+/* Finding matching block groups for all event locations
+   (mylib/bgassign.py does the same outside the database) */
 UPDATE driver_data
 SET bg_id = affgeoid
 FROM texas_bg_2018
@@ -91,7 +96,8 @@ CREATE TABLE journey_data AS
 		  ((local_time >= '2020-03-02'::timestamp AND local_time < '2020-03-07'::timestamp) OR
 	       (local_time >= '2020-04-06'::timestamp AND local_time < '2020-04-11'::timestamp));
 
-/* Create trip table - table with rows having both start and end of journey */
+/* Create trip table - table with rows having both start and end of journey
+   (mylib/tripbuild.py builds the final trip table below without the self-join) */
 CREATE TABLE trip_data AS
 	SELECT 
 		s.loc_geom as start_loc_geom, e.loc_geom as end_loc_geom,
@@ -180,7 +186,8 @@ WHERE journey_id IN (
 	WHERE tt_rank > 1
 );
 
-/* Creating variables for determining base location of vehicles */
+/* Creating variables for determining base location of vehicles
+   (mylib/staycalc.py computes the stay columns below in one pass) */
 ALTER TABLE trip_data
 ADD COLUMN next_start_loc_geom geometry(Point, 4326),
 ADD COLUMN next_bg_id varchar,
@@ -302,7 +309,8 @@ SET overnight_stay = CASE WHEN stay_indicator AND stay_duration IS NOT NULL
 						  THEN next_start_time > get_day_end(end_time)
 				     ELSE NULL END;
 
-/* Generate a table with the vehicles in the database */
+/* Generate a table with the vehicles in the database
+   (mylib/homeloc.py keeps this table up to date as new trips arrive) */
 /* Table has columns showing which block group the vehicle has spent maximum time at overall and on time periods containing 3 AM */
 CREATE TABLE vehicle_data AS
 	WITH tot_stay_cte AS (
@@ -1,63 +1,131 @@
 import pandas as pd
 import geopandas as gpd
+import shapely
 import os
+import time
 from mylib.layerfuse import layerfuse
+from mylib.layerio import write_layer
+from mylib.runstats import RunReport, stage
+from mylib.ctpp import read_industry_taz
 
 GIS_FOLDER = os.path.join('D:/', 'Wejo Project','Data', 'GIS')
+STATE_FIPS = '48' # Texas
+# County FIPS codes of the region of interest (Austin). Only the geometries in these
+# counties are read and fused. Set to None to run for the whole state.
+REGION_COUNTIES = ['453', '491', '209', '055', '021']
+# Formats of the compiled layer: "parquet" (GeoParquet), "feather" and/or the legacy
+# "shapefile", whose column names are truncated to 10 characters.
+OUTPUT_FORMATS = ['parquet']
+# The time, memory and rows of each stage of a run are saved as a JSON report in this
+# folder. Set TRACE_MEMORY to also trace the peak memory of each stage (slower) and
+# PROFILE to save a cProfile dump of the run next to the report.
+REPORT_FOLDER = os.path.join(GIS_FOLDER, 'run_reports')
+TRACE_MEMORY = False
+PROFILE = False
 
-industry_taz_dat = pd.read_csv(os.path.join(GIS_FOLDER, 'TX 2016 Industry TAZ.csv'), dtype=str).rename({'taz': 'taz_name'}, axis=1)
-for col in industry_taz_dat.columns[industry_taz_dat.columns!='taz_name']:
-    # I am doing this column by column with for loop because there is a bug in Python.
-    # That does not change dtype of multiple columns simultaneously after assignment.
-    # https://github.com/pandas-dev/pandas/issues/24269
-    industry_taz_dat[col] = pd.to_numeric(industry_taz_dat[col].str.replace(',',''))
-
-industry_taz_dat['taz'] = industry_taz_dat['taz_name'].str.extract('^TAZ ([0-9A-Z]+),')
-industry_taz_dat['county'] = industry_taz_dat['taz_name'].str.split(',').str[1].str.strip()
-industry_taz_dat['state'] = industry_taz_dat['taz_name'].str.split(',').str[-1].str.strip()
-
-county_fips = pd.read_csv(os.path.join(GIS_FOLDER, 'County_FIPS.csv'))
-county_fips = county_fips.loc[county_fips['fip'] // 1000 == 48].rename({'fip':'county_fip'}, axis=1) # Select only counties in Texas
-county_fips['county_fip'] = county_fips['county_fip'].map(lambda x: '%03d' % (x % 48000))
-industry_taz_dat = industry_taz_dat.merge(county_fips, how='inner', on='county')
-renamer = {'total': 'employment',
-           'Agriculture, forestry, fishing and hunting, and mining': 'emp_agriculture',
-           'Construction': 'emp_construct', 
-           'Manufacturing': 'emp_manufacture', 
-           'Wholesale trade': 'emp_wholesale', 
-           'Retail trade': 'emp_retail',
-           'Transportation and warehousing, and utilities': 'emp_transport', 
-           'Information': 'emp_information',
-           'Finance, insurance, real estate and rental and leasing': 'emp_finance',
-           'Professional, scientific, management, administrative,  and waste management services': 'emp_scientific',
-           'Educational, health and social services': 'emp_education',
-           'Arts, entertainment, recreation, accommodation and food services': 'emp_entertainment',
-           'Other services (except public administration)': 'emp_other',
-           'Public administration': 'emp_administration', 
-           'Armed forces': 'emp_military'}
-industry_taz_dat = industry_taz_dat.rename(renamer, axis=1)
-
-taz_shp = gpd.read_file(os.path.join(GIS_FOLDER, 'tl_2011_48_taz10', 'tl_2011_48_taz10.shp'))
-taz_shp = taz_shp.merge(industry_taz_dat.rename({'taz': 'TAZCE10', 'county_fip': 'COUNTYFP10'}, axis=1), 
-                        how='inner', on=['TAZCE10', 'COUNTYFP10'])
-bg_shp = gpd.read_file(os.path.join(GIS_FOLDER, 'Texas_BG_2018'))
-taz_shp = taz_shp.to_crs(bg_shp.crs)
-
-bg_shp = layerfuse(bg_shp, taz_shp, size_cols=list(renamer.values()), show_overlap=True)
-
-acs_dat = pd.read_csv(os.path.join(GIS_FOLDER, 'ACS TX 2018', 'ACS_bg_extract.csv'))
-acs_dat['GEOID'] = acs_dat.apply(lambda x: f'48{x["COUNTY"].astype(int):03d}{x["TRACT"].astype(int):06d}{x["BLKGRP"].astype(int)}'.format(x), axis=1)
-acs_dat = acs_dat.drop(['COUNTY', 'TRACT', 'BLKGRP'], axis=1)
-
-bg_shp = bg_shp.merge(acs_dat, on='GEOID')
-bg_shp = bg_shp.merge(county_fips, left_on='COUNTYFP', right_on='county_fip')
-
-bg_shp = bg_shp.loc[bg_shp['COUNTYFP'].isin(['453', '491', '209', '055', '021'])]
-taz_shp = taz_shp.loc[taz_shp['COUNTYFP10'].isin(['453', '491', '209', '055', '021'])]
-
-# ax = bg_shp.plot(column=bg_shp['employment']/bg_shp.to_crs(3857).area)
-# ax.set_ylim(30,30.5)
-# ax = taz_shp.plot(column=taz_shp['employment']/taz_shp.to_crs(3857).area)
-# ax.set_ylim(30,30.5)
-
-bg_shp.to_file(os.path.join(GIS_FOLDER, 'Austin_SocEco_BG', 'Austin_SocEco_BG.shp'))
+def read_region(path, county_col=None, counties=None, bbox=None):
+    ''' Reads only the features of a layer that are in the region of interest.
+
+    The filters are applied while reading the file, so that the features
+    outside the region are never loaded.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file or folder with the layer.
+    county_col : str, optional
+        Name of the column with the county FIPS codes.
+    counties : list of str, optional
+        County FIPS codes of the features to read. If None, features of all
+        counties are read.
+    bbox : gpd.GeoSeries, optional
+        Only features intersecting the bounds of this are read. It may be in
+        a different CRS than the layer.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        The features of the layer in the region.
+
+    '''
+    kwargs = dict()
+    if counties is not None:
+        kwargs['where'] = '%s IN (%s)' % (county_col, ', '.join("'%s'" % county for county in counties))
+    if bbox is not None:
+        kwargs['bbox'] = bbox
+    return gpd.read_file(path, **kwargs)
+
+run_name = 'Texas_SocEco_Compile_%s' % time.strftime('%Y%m%d_%H%M%S')
+with RunReport('Texas_SocEco_Compile', report_path=os.path.join(REPORT_FOLDER, run_name + '.json'),
+               trace_memory=TRACE_MEMORY,
+               profile_path=os.path.join(REPORT_FOLDER, run_name + '.prof') if PROFILE else None,
+               parameters={'region_counties': REGION_COUNTIES, 'output_formats': OUTPUT_FORMATS}):
+    with stage('read_industry_taz') as record:
+        industry_taz_dat = read_industry_taz(os.path.join(GIS_FOLDER, 'TX 2016 Industry TAZ.csv'))
+        record['rows'] = len(industry_taz_dat)
+
+    with stage('merge_county_fips') as record:
+        county_fips = pd.read_csv(os.path.join(GIS_FOLDER, 'County_FIPS.csv'))
+        county_fips = county_fips.loc[county_fips['fip'] // 1000 == int(STATE_FIPS)].rename({'fip':'county_fip'}, axis=1) # Select only counties in the state
+        county_fips['county_fip'] = county_fips['county_fip'].map(lambda x: '%03d' % (x % 1000))
+        industry_taz_dat = industry_taz_dat.merge(county_fips, how='inner', on='county')
+        record['rows'] = len(industry_taz_dat)
+    renamer = {'total': 'employment',
+               'Agriculture, forestry, fishing and hunting, and mining': 'emp_agriculture',
+               'Construction': 'emp_construct', 
+               'Manufacturing': 'emp_manufacture', 
+               'Wholesale trade': 'emp_wholesale', 
+               'Retail trade': 'emp_retail',
+               'Transportation and warehousing, and utilities': 'emp_transport', 
+               'Information': 'emp_information',
+               'Finance, insurance, real estate and rental and leasing': 'emp_finance',
+               'Professional, scientific, management, administrative,  and waste management services': 'emp_scientific',
+               'Educational, health and social services': 'emp_education',
+               'Arts, entertainment, recreation, accommodation and food services': 'emp_entertainment',
+               'Other services (except public administration)': 'emp_other',
+               'Public administration': 'emp_administration', 
+               'Armed forces': 'emp_military'}
+    industry_taz_dat = industry_taz_dat.rename(renamer, axis=1)
+
+    with stage('read_bg_shp') as record:
+        bg_shp = read_region(os.path.join(GIS_FOLDER, 'Texas_BG_2018'), county_col='COUNTYFP', counties=REGION_COUNTIES)
+        record['rows'] = len(bg_shp)
+    # TAZs from neighbouring counties may overlap the edges of the region, so the TAZs are
+    # selected by the bounds of the block groups rather than by county.
+    region_bounds = None if REGION_COUNTIES is None else gpd.GeoSeries([shapely.box(*bg_shp.total_bounds)], crs=bg_shp.crs)
+    with stage('read_taz_shp') as record:
+        taz_shp = read_region(os.path.join(GIS_FOLDER, 'tl_2011_%s_taz10' % STATE_FIPS, 'tl_2011_%s_taz10.shp' % STATE_FIPS), bbox=region_bounds)
+        record['rows'] = len(taz_shp)
+    with stage('merge_industry_taz') as record:
+        taz_shp = taz_shp.merge(industry_taz_dat.rename({'taz': 'TAZCE10', 'county_fip': 'COUNTYFP10'}, axis=1), 
+                                how='inner', on=['TAZCE10', 'COUNTYFP10'])
+        record['rows'] = len(taz_shp)
+    with stage('to_crs', rows=len(taz_shp)):
+        taz_shp = taz_shp.to_crs(bg_shp.crs)
+
+    with stage('layerfuse', rows=len(bg_shp)):
+        bg_shp = layerfuse(bg_shp, taz_shp, size_cols=list(renamer.values()), show_overlap=True)
+
+    with stage('read_acs') as record:
+        # The GEOID of the block groups is written by the ACS extractor
+        acs_dat = pd.read_csv(os.path.join(GIS_FOLDER, 'ACS TX 2018', 'ACS_bg_extract.csv'), dtype={'GEOID': str})
+        acs_dat = acs_dat.drop(['STATE', 'COUNTY', 'TRACT', 'BLKGRP'], axis=1, errors='ignore')
+        record['rows'] = len(acs_dat)
+
+    with stage('merge_acs') as record:
+        bg_shp = bg_shp.merge(acs_dat, on='GEOID')
+        bg_shp = bg_shp.merge(county_fips, left_on='COUNTYFP', right_on='county_fip')
+        record['rows'] = len(bg_shp)
+
+    if REGION_COUNTIES is not None:
+        taz_shp = taz_shp.loc[taz_shp['COUNTYFP10'].isin(REGION_COUNTIES)]
+
+    # ax = bg_shp.plot(column=bg_shp['employment']/bg_shp.to_crs(3857).area)
+    # ax.set_ylim(30,30.5)
+    # ax = taz_shp.plot(column=taz_shp['employment']/taz_shp.to_crs(3857).area)
+    # ax.set_ylim(30,30.5)
+
+    os.makedirs(os.path.join(GIS_FOLDER, 'Austin_SocEco_BG'), exist_ok=True)
+    for output_format in OUTPUT_FORMATS:
+        with stage('write_layer_%s' % output_format, rows=len(bg_shp)):
+            write_layer(bg_shp, os.path.join(GIS_FOLDER, 'Austin_SocEco_BG', 'Austin_SocEco_BG'), format=output_format)
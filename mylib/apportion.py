@@ -0,0 +1,93 @@
+""" Apportioning of county-tract values into their block groups. """
+
+import numpy as np
+import pandas as pd
+
+
+def tract_positions(bg_tract_keys, tract_keys):
+    """ Finds the row of the county-tract of each block group.
+
+    The positions only depend on the keys and their order, so they can be
+    computed once and reused for every apportioning of the same rows, eg.
+    for every vintage with the same block groups and county-tracts.
+
+    Parameters
+    ----------
+    bg_tract_keys : array-like
+        Key of the county-tract of each block group, eg. CTLOGRECNO.
+    tract_keys : array-like
+        Key of each county-tract row, eg. LOGRECNO.
+
+    Returns
+    -------
+    np.ndarray of int
+        Position in `tract_keys` of each of `bg_tract_keys`.
+
+    """
+
+    positions = pd.Index(tract_keys).get_indexer(bg_tract_keys)
+    if (positions < 0).any():
+        missing = np.asarray(bg_tract_keys)[positions < 0]
+        raise KeyError(f'{len(missing)} county-tracts of block groups not found, eg. {missing[:5].tolist()}')
+    return positions
+
+def apportion_ct_to_bg(acs_ct_dat, acs_bg_dat, specs, positions=None, tract_key='LOGRECNO', bg_tract_key='CTLOGRECNO'):
+    """ Splits the county-tract data of several column groups into block groups.
+
+    Each spec is applied as `disintegrate_ct_to_bg` in ACS2018_Column_Extractor
+    would, but the county-tract rows are gathered by position once for all
+    the specs. The `based_on` values used are those of `acs_bg_dat` before
+    any of the specs are applied.
+    Operation is NOT inplace.
+
+    Parameters
+    ----------
+    acs_ct_dat : pd.DataFrame
+        County-tract data.
+    acs_bg_dat : pd.DataFrame
+        Block group data.
+    specs : list of tuple
+        (columns, based_on) pairs. If `based_on` is a column name, the
+        county-tract values of `columns` are split between the block groups
+        in proportion to their `based_on` values. If None, the county-tract
+        values are copied into the block groups.
+    positions : np.ndarray of int, optional
+        Row of `acs_ct_dat` of the county-tract of each row of `acs_bg_dat`,
+        as returned by `tract_positions`. Found from the keys if not given.
+    tract_key, bg_tract_key : str, optional
+        Columns with the key of the county-tracts in `acs_ct_dat` and
+        `acs_bg_dat`.
+
+    Returns
+    -------
+    acs_bg_dat : pd.DataFrame
+        Copy of `acs_bg_dat` with the columns of every spec altered based on
+        `acs_ct_dat`.
+
+    """
+
+    if positions is None:
+        positions = tract_positions(acs_bg_dat[bg_tract_key], acs_ct_dat[tract_key])
+    acs_bg_dat = acs_bg_dat.copy()
+
+    apportioned = dict()
+    for columns, based_on in specs:
+        columns = list(columns)
+        ct_values = acs_ct_dat[columns].to_numpy()[positions]
+        if based_on is not None: # Split the census tract value between block groups based on 'based_on'
+            bg_total = acs_bg_dat[based_on].sum()
+            ct_total = acs_ct_dat[based_on].sum()
+            if abs((bg_total - ct_total) / ct_total) > .001:
+                raise Exception(f'{based_on} values not consistent across census tracts and block groups.\nTotal {based_on} across block groups = {bg_total} \nTotal {based_on} across census tracts = {ct_total}')
+
+            ct_based_on = acs_ct_dat[based_on].to_numpy()[positions]
+            with np.errstate(divide='ignore', invalid='ignore'): # Supress zero-division warning
+                fraction = acs_bg_dat[based_on].to_numpy() / ct_based_on
+            fraction[ct_based_on == 0] = 0
+            ct_values = ct_values * fraction.reshape((-1, 1))
+        for i, column in enumerate(columns):
+            apportioned[column] = ct_values[:, i]
+
+    for column, values in apportioned.items():
+        acs_bg_dat[column] = values
+    return acs_bg_dat
@@ -0,0 +1,191 @@
+""" Assignment of vehicle events to the block groups containing them.
+
+Replaces the PostGIS update in SQL_Commands.sql
+
+    UPDATE driver_data SET bg_id = affgeoid
+    FROM texas_bg_2018 WHERE ST_Within(loc_geom, geom);
+
+with bulk queries of an STRtree over the block groups. Points on the
+boundary of a block group are not within it, as with ST_Within.
+
+Run as a script from the repository root to benchmark on synthetic events:
+    python -m mylib.bgassign --events 5000000
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+import geopandas as gpd
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+
+# Time taken by the ST_Within update in SQL_Commands.sql (13 min 47 secs)
+SQL_SECONDS = 13 * 60 + 47
+
+_WORKER_INDEX = None
+
+def load_block_groups(path, id_col="AFFGEOID"):
+    """ Reads the block groups in the CRS of the events (EPSG:4326).
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Geometries and identifiers of the block groups.
+
+    """
+
+    bg_layer = gpd.read_file(path, columns=[id_col]).to_crs(4326)
+    return bg_layer.geometry.to_numpy(), bg_layer[id_col].to_numpy()
+
+def assign_bg(lon, lat, bg_geometry, bg_ids, tree=None):
+    """ Finds the block group containing each point.
+
+    Parameters
+    ----------
+    lon, lat : array-like of float
+        Coordinates of the events in EPSG:4326.
+    bg_geometry : np.ndarray of shapely.Geometry
+        Block group polygons in EPSG:4326.
+    bg_ids : np.ndarray
+        Identifier of each block group.
+    tree : shapely.STRtree, optional
+        Index over `bg_geometry`. Built if not given; pass it when assigning
+        several batches against the same block groups.
+
+    Returns
+    -------
+    np.ndarray
+        Identifier of the block group of each point, None for points that
+        are not within any block group. If the block groups overlap, the
+        first one is used.
+
+    """
+
+    if tree is None:
+        tree = shapely.STRtree(bg_geometry)
+    points = shapely.points(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+    point_position, bg_position = tree.query(points, predicate="within")
+    order = np.lexsort((bg_position, point_position))
+    point_position, first = np.unique(point_position[order], return_index=True)
+
+    assigned = np.full(len(points), None, dtype=object)
+    assigned[point_position] = bg_ids[bg_position[order][first]]
+    return assigned
+
+def _init_worker(bg_geometry, bg_ids):
+    """ Builds the block group index once in each worker process. """
+
+    global _WORKER_INDEX
+    _WORKER_INDEX = (bg_geometry, bg_ids, shapely.STRtree(bg_geometry))
+
+def _assign_batch(lon, lat):
+    """ Assigns one batch of events with the index of the worker process. """
+
+    bg_geometry, bg_ids, tree = _WORKER_INDEX
+    return assign_bg(lon, lat, bg_geometry, bg_ids, tree=tree)
+
+def assign_bg_batches(lon, lat, bg_geometry, bg_ids, batch_size=1_000_000, n_jobs=None):
+    """ Assigns block groups to events in batches over a pool of processes.
+
+    Each process builds its own STRtree once and then queries the batches
+    sent to it. On Windows, the calling script should be guarded with
+    `if __name__ == "__main__":`.
+
+    Parameters
+    ----------
+    lon, lat, bg_geometry, bg_ids
+        As in `assign_bg`.
+    batch_size : int, optional
+        Number of events sent to a process at a time.
+    n_jobs : int, optional
+        Number of processes. Defaults to the number of CPUs. With 1 the
+        batches are assigned in the calling process.
+
+    Returns
+    -------
+    np.ndarray
+        Identifier of the block group of each event, as in `assign_bg`.
+
+    """
+
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    starts = range(0, len(lon), batch_size)
+    n_jobs = n_jobs or os.cpu_count()
+    if n_jobs == 1 or len(starts) <= 1:
+        tree = shapely.STRtree(bg_geometry)
+        batches = [assign_bg(lon[start:start + batch_size], lat[start:start + batch_size], bg_geometry, bg_ids, tree=tree)
+                   for start in starts]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(starts)), initializer=_init_worker,
+                                 initargs=(bg_geometry, bg_ids)) as executor:
+            batches = list(executor.map(_assign_batch, [lon[start:start + batch_size] for start in starts],
+                                        [lat[start:start + batch_size] for start in starts]))
+    return np.concatenate(batches) if batches else np.empty(0, dtype=object)
+
+def synthetic_block_groups(n_block_groups=16000, bounds=(-106.6, 25.8, -93.5, 36.5), seed=0):
+    """ Generates Voronoi cells of random points as stand-in block groups.
+
+    The default bounds and number of cells are those of Texas and its 2018
+    block groups.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    points = np.column_stack([rng.uniform(minx, maxx, n_block_groups), rng.uniform(miny, maxy, n_block_groups)])
+    extent = shapely.box(*bounds)
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=extent))
+    cells = shapely.intersection(cells, extent)
+    bg_ids = np.array(["1500000US48%010d" % i for i in range(len(cells))], dtype=object)
+    return cells, bg_ids
+
+def benchmark_bgassign(n_events=5_000_000, n_block_groups=16000, batch_size=1_000_000, n_jobs=None, seed=0):
+    """ Times the assignment of synthetic events and compares it to the SQL.
+
+    The assignment of a sample of the events is checked against a plain
+    `shapely.within` of each point with every block group whose bounds
+    contain it.
+
+    Returns
+    -------
+    dict
+        Wall time in seconds, events per minute and speedup over the time of
+        the SQL update (`SQL_SECONDS`). The number of events in that update
+        is not recorded, so the speedup is only indicative.
+
+    """
+
+    bg_geometry, bg_ids = synthetic_block_groups(n_block_groups, seed=seed)
+    minx, miny, maxx, maxy = shapely.total_bounds(bg_geometry)
+    rng = np.random.default_rng(seed + 1)
+    lon = rng.uniform(minx, maxx, n_events)
+    lat = rng.uniform(miny, maxy, n_events)
+
+    start = time.perf_counter()
+    assigned = assign_bg_batches(lon, lat, bg_geometry, bg_ids, batch_size=batch_size, n_jobs=n_jobs)
+    elapsed = time.perf_counter() - start
+
+    sample = rng.choice(n_events, size=min(n_events, 1000), replace=False)
+    for position in sample:
+        inside = shapely.within(shapely.Point(lon[position], lat[position]), bg_geometry)
+        expected = bg_ids[inside][0] if inside.any() else None
+        assert assigned[position] == expected, f"Event {position} is assigned to the wrong block group"
+
+    results = {"events": n_events, "block_groups": len(bg_geometry), "seconds": elapsed,
+               "events_per_minute": n_events / elapsed * 60, "sql_seconds": SQL_SECONDS,
+               "speedup": SQL_SECONDS / elapsed}
+    print(f"Assigned {n_events} events to {len(bg_geometry)} block groups in {elapsed:.1f} s "
+          f"({results['events_per_minute']:,.0f} events per minute, SQL update took {SQL_SECONDS} s)")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the block group assignment on synthetic events.")
+    parser.add_argument("--events", type=int, default=5_000_000, help="Number of synthetic events.")
+    parser.add_argument("--block-groups", type=int, default=16000, help="Number of synthetic block groups.")
+    parser.add_argument("--batch-size", type=int, default=1_000_000, help="Events per batch.")
+    parser.add_argument("--jobs", type=int, help="Number of processes.")
+    args = parser.parse_args()
+
+    benchmark_bgassign(args.events, args.block_groups, args.batch_size, args.jobs)
@@ -0,0 +1,110 @@
+""" Readers for the CTPP tables of employment by TAZ.
+
+Run as a script from the repository root to benchmark `read_industry_taz`
+against the original reader on a generated national-sized table:
+    python -m mylib.ctpp --taz 700000
+"""
+
+import argparse
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Industry columns of the CTPP table, after the total
+INDUSTRY_COLUMNS = ['Agriculture, forestry, fishing and hunting, and mining', 'Construction', 'Manufacturing',
+                    'Wholesale trade', 'Retail trade', 'Transportation and warehousing, and utilities', 'Information',
+                    'Finance, insurance, real estate and rental and leasing',
+                    'Professional, scientific, management, administrative,  and waste management services',
+                    'Educational, health and social services',
+                    'Arts, entertainment, recreation, accommodation and food services',
+                    'Other services (except public administration)', 'Public administration', 'Armed forces']
+
+def read_industry_taz(path):
+    ''' Reads the CTPP table of employment by industry for each TAZ.
+
+    The counts are parsed as numbers directly, with their thousands 
+    separators. The TAZ names, like "TAZ 48453001234, Travis County, Texas",
+    are split once into the TAZ code, county and state. The county and state
+    are stored as categoricals.
+
+    Parameters
+    ----------
+    path : str
+        Path of the CSV file, with the TAZ names in the column "taz".
+
+    Returns
+    -------
+    industry_taz_dat : pd.DataFrame
+        The table with the TAZ names in "taz_name" and the new columns "taz",
+        "county" and "state".
+
+    '''
+    industry_taz_dat = pd.read_csv(path, thousands=',', dtype={'taz': str}).rename({'taz': 'taz_name'}, axis=1)
+    names = industry_taz_dat['taz_name'].str.extract(r'^TAZ (?P<taz>[0-9A-Z]+),\s*(?P<county>[^,]*?)\s*,(?:.*,)?\s*(?P<state>[^,]*?)\s*$')
+    industry_taz_dat['taz'] = names['taz']
+    industry_taz_dat['county'] = names['county'].astype('category')
+    industry_taz_dat['state'] = names['state'].astype('category')
+    return industry_taz_dat
+
+def _read_industry_taz_text(path):
+    ''' The original reader: every column read as text and converted one by one. '''
+    industry_taz_dat = pd.read_csv(path, dtype=str).rename({'taz': 'taz_name'}, axis=1)
+    for col in industry_taz_dat.columns[industry_taz_dat.columns!='taz_name']:
+        industry_taz_dat[col] = pd.to_numeric(industry_taz_dat[col].str.replace(',',''))
+    industry_taz_dat['taz'] = industry_taz_dat['taz_name'].str.extract('^TAZ ([0-9A-Z]+),')
+    industry_taz_dat['county'] = industry_taz_dat['taz_name'].str.split(',').str[1].str.strip()
+    industry_taz_dat['state'] = industry_taz_dat['taz_name'].str.split(',').str[-1].str.strip()
+    return industry_taz_dat
+
+def synthetic_industry_taz(path, n_taz=700000, seed=0):
+    ''' Writes a CTPP-like table of `n_taz` TAZs spread over 3,000 counties. '''
+    rng = np.random.default_rng(seed)
+    county = rng.integers(0, 3000, n_taz)
+    state_names = np.array(["State %d" % state for state in range(52)])
+    names = pd.Series(["TAZ %02d%03d%06d, County %d, %s" % (c // 60, c % 60, i, c, state_names[c // 60])
+                       for i, c in enumerate(county)])
+    table = pd.DataFrame({'taz': names})
+    counts = rng.integers(0, 20000, (n_taz, len(INDUSTRY_COLUMNS)))
+    table['total'] = counts.sum(axis=1)
+    for i, column in enumerate(INDUSTRY_COLUMNS):
+        table[column] = counts[:, i]
+    for column in table.columns[1:]:
+        table[column] = table[column].map('{:,}'.format)
+    table.to_csv(path, index=False)
+
+def benchmark_read_industry_taz(n_taz=700000):
+    ''' Compares `read_industry_taz` with the original reader on a generated table.
+
+    Returns
+    -------
+    pd.DataFrame
+        Wall time in seconds, peak traced memory and memory of the result in
+        MB of each reader.
+
+    '''
+    from mylib.runstats import measure
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'industry_taz.csv')
+        synthetic_industry_taz(path, n_taz)
+        results = dict()
+        tables = dict()
+        for name, reader in (('text', _read_industry_taz_text), ('typed', read_industry_taz)):
+            tables[name], elapsed, peak = measure(reader, path)
+            results[name] = {'seconds': elapsed, 'peak_mb': peak / 2**20,
+                             'result_mb': tables[name].memory_usage(deep=True).sum() / 2**20}
+
+    pd.testing.assert_frame_equal(tables['typed'].astype({'county': object, 'state': object}),
+                                  tables['text'].astype({'county': object, 'state': object}), check_dtype=False)
+    results = pd.DataFrame(results).T
+    print(f'Reading the industries of {n_taz} TAZs')
+    print(results)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the reader of the CTPP industry table.")
+    parser.add_argument("--taz", type=int, default=700000, help="Number of TAZs of the generated table.")
+    args = parser.parse_args()
+
+    benchmark_read_industry_taz(args.taz)
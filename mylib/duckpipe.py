@@ -0,0 +1,422 @@
+""" SQL_Commands.sql pipeline on an embedded DuckDB database.
+
+Runs the transformations of SQL_Commands.sql without a PostgreSQL/PostGIS
+server, reading the Parquet event files written by
+`mylib.eventstream.write_events_parquet` directly. Every stage is a
+CREATE TABLE AS, so no table is rewritten by full-table UPDATEs:
+
+    driver_data       view of the events with local_time, local_day_hour,
+                      tod and day_of_week
+    journey_events    distinct journey events in the periods
+    journey_data      journey events with their block group (ST_Within)
+    trip_pairs        START/END self-join with the three heuristics
+    trip_data         trips with the stay columns
+    vehicle_data      block groups of the longest total and overnight stays,
+                      with the durations in integer microseconds (tot_us,
+                      night_us)
+
+Only the journey events in the periods are assigned a block group, since no
+other event is used. Ties left to the database by the SQL are broken as in
+`mylib.tripbuild` and `mylib.homeloc`, so that `vehicle_data` is the same as
+`mylib.homeloc.rebuild_vehicle_data`.
+
+Run as a script from the repository root:
+    python -m mylib.duckpipe --events events.parquet --block-groups Texas_BG_2018 --output vehicle_data.parquet
+or, to check the pipeline against mylib on synthetic events:
+    python -m mylib.duckpipe --check
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import shapely
+
+from mylib.bgassign import assign_bg, load_block_groups, synthetic_block_groups
+from mylib.homeloc import rebuild_vehicle_data, vehicle_frame
+from mylib.timefeatures import TIMEZONE, TOD_EDGES, TOD_LABELS, add_time_features
+from mylib.tripbuild import JOURNEY_PERIODS, TRIP_TARGET, build_trips, journey_events
+from mylib.staycalc import STAY_LIMIT
+from mylib.eventstream import EVENT_COLUMNS
+
+# Bounds of the synthetic events of `check_synthetic`, around Austin
+AUSTIN_BOUNDS = (-98.2, 30.0, -97.4, 30.6)
+
+_US_PER_HOUR = 3600000000
+_US_PER_DAY = 24 * _US_PER_HOUR
+
+def _sql_list(values):
+    """ Formats strings as a SQL list of literals. """
+
+    return "[%s]" % ", ".join("'%s'" % str(value).replace("'", "''") for value in values)
+
+def _tod_case(column):
+    """ Builds the CASE of the time of day buckets from the milliseconds since midnight. """
+
+    edges = [int(edge * _US_PER_HOUR // 1000) for edge in TOD_EDGES] + [_US_PER_DAY // 1000]
+    labels = TOD_LABELS + ["Night"]
+    whens = " ".join(f"WHEN {column} < {edge} THEN '{label}'" for edge, label in zip(edges, labels))
+    return f"CASE {whens} END"
+
+def pipeline_stages(event_paths, periods=JOURNEY_PERIODS, timezone=TIMEZONE, target=TRIP_TARGET):
+    """ Builds the SQL of each stage of the pipeline.
+
+    Parameters
+    ----------
+    event_paths : list of str
+        Parquet files of events with the `mylib.eventstream.EVENT_COLUMNS`.
+    periods : list of tuple, optional
+        Periods of local time of the journey events, as in
+        `mylib.tripbuild.journey_events`.
+    timezone : str, optional
+        Time zone of the local time.
+    target : pd.Timedelta, optional
+        Preferred travel time of the trip heuristics.
+
+    Returns
+    -------
+    list of tuple
+        (table, sql) of each stage, in order. The stages expect a
+        block_groups table as built by `load_block_group_table`.
+
+    """
+
+    in_periods = " OR ".join(f"(local_time >= TIMESTAMP '{pd.Timestamp(start)}' AND "
+                             f"local_time < TIMESTAMP '{pd.Timestamp(end)}')" for start, end in periods)
+    target_us = target // pd.Timedelta(microseconds=1)
+    limit_us = STAY_LIMIT // pd.Timedelta(microseconds=1)
+    # get_day_end rounds the time of day to whole seconds, see mylib.staycalc
+    day_end_cutoff_us = 3 * _US_PER_HOUR + 500000
+
+    return [
+        ("driver_data", f"""
+            CREATE OR REPLACE VIEW driver_data AS
+            WITH events AS (
+                SELECT *, timezone('{timezone}', epoch_ms(captured_timestamp)::TIMESTAMPTZ) AS local_time
+                FROM read_parquet({_sql_list(event_paths)})
+            ),
+            day_times AS (
+                SELECT *, epoch_ms(local_time) % 86400000 AS ms_of_day
+                FROM events
+            )
+            SELECT * EXCLUDE (ms_of_day),
+                   ms_of_day / 3600000 AS local_day_hour,
+                   {_tod_case("ms_of_day")} AS tod,
+                   dayofweek(local_time) AS day_of_week
+            FROM day_times"""),
+
+        ("journey_events", f"""
+            CREATE OR REPLACE TABLE journey_events AS
+            SELECT row_number() OVER () AS event_id, *
+            FROM (
+                SELECT DISTINCT longitude, latitude, local_time, local_day_hour, tod, day_of_week,
+                                device_id, journey_id, journey_event, zip_code
+                FROM driver_data
+                WHERE event_type = 'JOURNEY' AND ({in_periods})
+            )"""),
+
+        # The block group is a function of the location, so it is found after
+        # DISTINCT. The bounds are checked first so that ST_Within is only
+        # evaluated against the few block groups around each event.
+        ("journey_data", """
+            CREATE OR REPLACE TABLE journey_data AS
+            WITH within AS (
+                SELECT j.event_id, min_by(b.bg_id, b.bg_pos) AS bg_id
+                FROM journey_events AS j
+                JOIN block_groups AS b
+                  ON j.longitude BETWEEN b.minx AND b.maxx AND
+                     j.latitude BETWEEN b.miny AND b.maxy AND
+                     ST_Within(ST_Point(j.longitude, j.latitude), b.geom)
+                GROUP BY j.event_id
+            )
+            SELECT j.longitude, j.latitude, w.bg_id, j.local_time, j.local_day_hour, j.tod, j.day_of_week,
+                   j.device_id, j.journey_id, j.journey_event, j.zip_code
+            FROM journey_events AS j
+            LEFT JOIN within AS w ON j.event_id = w.event_id"""),
+
+        ("trip_pairs", f"""
+            CREATE OR REPLACE TABLE trip_pairs AS
+            WITH pairs AS (
+                SELECT s.longitude AS start_longitude, s.latitude AS start_latitude,
+                       e.longitude AS end_longitude, e.latitude AS end_latitude,
+                       s.bg_id AS start_bg_id, e.bg_id AS end_bg_id,
+                       s.local_time AS start_time, e.local_time AS end_time,
+                       e.local_time - s.local_time AS travel_time,
+                       s.tod, s.day_of_week, s.device_id, s.journey_id,
+                       abs(epoch_us(e.local_time) - epoch_us(s.local_time) - {target_us}) AS target_diff
+                FROM journey_data AS s
+                JOIN journey_data AS e
+                  ON s.device_id = e.device_id AND s.journey_id = e.journey_id
+                WHERE s.journey_event = 'START' AND e.journey_event = 'END' AND s.local_time < e.local_time
+            ),
+            closest AS (
+                SELECT * FROM pairs
+                QUALIFY row_number() OVER (PARTITION BY journey_id ORDER BY target_diff, start_time, end_time) = 1
+            ),
+            distinct_trips AS (
+                SELECT * FROM closest
+                QUALIFY row_number() OVER (PARTITION BY device_id, start_longitude, start_latitude, end_longitude,
+                                           end_latitude, start_time, end_time ORDER BY journey_id) = 1
+            )
+            SELECT * EXCLUDE (target_diff) FROM distinct_trips
+            QUALIFY row_number() OVER (PARTITION BY device_id, start_time ORDER BY target_diff, journey_id) = 1"""),
+
+        ("trip_data", f"""
+            CREATE OR REPLACE TABLE trip_data AS
+            WITH next_trips AS (
+                SELECT *,
+                       lead(start_longitude) OVER next_trip AS next_start_longitude,
+                       lead(start_latitude) OVER next_trip AS next_start_latitude,
+                       lead(start_bg_id) OVER next_trip AS next_bg_id,
+                       lead(start_time) OVER next_trip AS next_start_time
+                FROM trip_pairs
+                WINDOW next_trip AS (PARTITION BY device_id ORDER BY start_time)
+            ),
+            indicators AS (
+                SELECT *,
+                       epoch_us(next_start_time) - epoch_us(end_time) AS stay_us,
+                       CASE WHEN epoch_us(next_start_time) - epoch_us(end_time) < {limit_us}
+                            THEN end_bg_id = next_bg_id END AS stay_indicator
+                FROM next_trips
+            )
+            SELECT * EXCLUDE (stay_us),
+                   CASE WHEN stay_indicator AND stay_us >= 0 THEN next_start_time - end_time END AS stay_duration,
+                   CASE WHEN stay_indicator AND stay_us >= 0
+                        THEN next_start_time > end_time::DATE +
+                             CASE WHEN epoch_us(end_time) % {_US_PER_DAY} < {day_end_cutoff_us}
+                                  THEN INTERVAL 3 HOUR ELSE INTERVAL 27 HOUR END
+                   END AS overnight_stay
+            FROM indicators
+            ORDER BY device_id, start_time"""),
+
+        ("vehicle_data", """
+            CREATE OR REPLACE TABLE vehicle_data AS
+            WITH sums AS (
+                SELECT device_id, next_bg_id AS bg_id,
+                       sum(epoch_us(next_start_time) - epoch_us(end_time))::BIGINT AS tot_us,
+                       sum(CASE WHEN overnight_stay THEN epoch_us(next_start_time) - epoch_us(end_time)
+                                ELSE 0 END)::BIGINT AS night_us
+                FROM trip_data
+                WHERE stay_duration IS NOT NULL
+                GROUP BY device_id, next_bg_id
+            ),
+            tot_stay AS (
+                SELECT * FROM sums
+                QUALIFY row_number() OVER (PARTITION BY device_id ORDER BY tot_us DESC, bg_id) = 1
+            ),
+            night_stay AS (
+                SELECT * FROM sums WHERE night_us > 0
+                QUALIFY row_number() OVER (PARTITION BY device_id ORDER BY night_us DESC, bg_id) = 1
+            )
+            SELECT t.device_id, t.tot_us, t.bg_id AS tot_stay_bg_id, n.night_us, n.bg_id AS night_stay_bg_id
+            FROM tot_stay AS t
+            JOIN night_stay AS n ON t.device_id = n.device_id
+            ORDER BY t.device_id"""),
+    ]
+
+def connect(database=":memory:", threads=None):
+    """ Opens a DuckDB database with the spatial extension loaded.
+
+    Timestamps without time zone are read as UTC, as with SET timezone in
+    the SQL before local_time is computed.
+
+    """
+
+    import duckdb
+
+    con = duckdb.connect(database)
+    con.install_extension("spatial")
+    con.load_extension("spatial")
+    con.execute("SET TimeZone = 'UTC'")
+    if threads is not None:
+        con.execute(f"SET threads = {int(threads)}")
+    return con
+
+def load_block_group_table(con, bg_geometry, bg_ids):
+    """ Creates the block_groups table from polygons in EPSG:4326.
+
+    The polygons are passed as WKB with their bounds, and their position is
+    kept so that an event within several block groups gets the first one,
+    as with `mylib.bgassign.assign_bg`.
+
+    """
+
+    bounds = shapely.bounds(bg_geometry)
+    block_groups = pd.DataFrame({"bg_pos": np.arange(len(bg_ids)), "bg_id": np.asarray(bg_ids, dtype=object),
+                                 "wkb": shapely.to_wkb(bg_geometry), "minx": bounds[:, 0], "miny": bounds[:, 1],
+                                 "maxx": bounds[:, 2], "maxy": bounds[:, 3]})
+    con.register("block_groups_wkb", block_groups)
+    con.execute("""
+        CREATE OR REPLACE TABLE block_groups AS
+        SELECT bg_pos, bg_id, ST_GeomFromWKB(wkb) AS geom, minx, miny, maxx, maxy
+        FROM block_groups_wkb""")
+    con.unregister("block_groups_wkb")
+
+def run_pipeline(event_paths, block_groups, database=":memory:", threads=None, verbose=False, **kwargs):
+    """ Runs the pipeline and returns vehicle_data.
+
+    Parameters
+    ----------
+    event_paths : str or list of str
+        Parquet files of events, as written by
+        `mylib.eventstream.write_events_parquet`.
+    block_groups : str or tuple
+        Path of the block group layer, read with
+        `mylib.bgassign.load_block_groups`, or its (geometries, ids) in
+        EPSG:4326.
+    database : str, optional
+        DuckDB database file in which the tables are kept. By default the
+        tables are only kept in memory.
+    threads : int, optional
+        Number of threads of DuckDB, all the CPUs if None.
+    verbose : bool, optional
+        Whether to print the time taken by each stage.
+    **kwargs
+        Passed to `pipeline_stages`.
+
+    Returns
+    -------
+    pd.DataFrame
+        vehicle_data, with the columns and dtypes of
+        `mylib.homeloc.rebuild_vehicle_data`.
+
+    """
+
+    if isinstance(event_paths, str):
+        event_paths = [event_paths]
+    bg_geometry, bg_ids = load_block_groups(block_groups) if isinstance(block_groups, str) else block_groups
+
+    con = connect(database, threads=threads)
+    try:
+        load_block_group_table(con, bg_geometry, bg_ids)
+        for table, sql in pipeline_stages(event_paths, **kwargs):
+            start = time.perf_counter()
+            con.execute(sql)
+            if verbose:
+                print(f"{table}: {time.perf_counter() - start:.1f} s")
+        rows = con.execute("""
+            SELECT device_id, tot_us, tot_stay_bg_id, night_us, night_stay_bg_id
+            FROM vehicle_data""").fetchall()
+    finally:
+        con.close()
+    return vehicle_frame(rows)
+
+def synthetic_events(n_devices=200, n_block_groups=100, bounds=AUSTIN_BOUNDS, periods=JOURNEY_PERIODS,
+                     timezone=TIMEZONE, seed=0):
+    """ Generates journeys of vehicles between home and work locations.
+
+    Each device makes a morning and an evening trip on most days of the
+    periods, and some other events. Some journeys have a second END, some
+    events are duplicated, and some trips start outside the block groups,
+    so that the heuristics of the pipeline are exercised.
+
+    Returns
+    -------
+    events : pd.DataFrame
+        Events with the `mylib.eventstream.EVENT_COLUMNS`.
+    bg_geometry, bg_ids : np.ndarray
+        Synthetic block groups, as `mylib.bgassign.synthetic_block_groups`.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    bg_geometry, bg_ids = synthetic_block_groups(n_block_groups, bounds=bounds, seed=seed)
+    minx, miny, maxx, maxy = bounds
+    days = pd.DatetimeIndex(np.concatenate([pd.date_range(start, end, freq="D", inclusive="left")
+                                            for start, end in periods]))
+
+    rows = list()
+    for device in range(n_devices):
+        device_id = "d%05d" % device
+        places = np.column_stack([rng.uniform(minx, maxx, 3), rng.uniform(miny, maxy, 3)])
+        if device % 10 == 0:
+            places[2] = (maxx + 1.0, maxy + 1.0) # Outside the block groups
+        for day in days:
+            if rng.random() < 0.1:
+                continue
+            for hour, origin, destination in ((rng.uniform(6, 9), 0, 1), (rng.uniform(16, 20), 1, 0),
+                                              (rng.uniform(20, 23), 0, 2)):
+                if destination == 2 and rng.random() < 0.7:
+                    continue
+                journey_id = "j%d" % len(rows)
+                start = day + pd.Timedelta(hours=hour)
+                end = start + pd.Timedelta(minutes=rng.uniform(5, 60))
+                rows.append((places[origin], start, device_id, journey_id, "JOURNEY", "START"))
+                rows.append((places[destination], end, device_id, journey_id, "JOURNEY", "END"))
+                if rng.random() < 0.05: # A second END of the same journey
+                    rows.append((places[destination], end + pd.Timedelta(minutes=rng.uniform(1, 90)), device_id,
+                                 journey_id, "JOURNEY", "END"))
+                if rng.random() < 0.05:
+                    rows.append(rows[-1])
+                if rng.random() < 0.2:
+                    rows.append((places[origin], start - pd.Timedelta(minutes=1), device_id, journey_id, "IGNITION",
+                                 None))
+
+    location, local_time, device_id, journey_id, event_type, journey_event = zip(*rows)
+    location = np.array(location)
+    local_time = pd.DatetimeIndex(local_time).round("ms").tz_localize(timezone, ambiguous="NaT", nonexistent="NaT")
+    captured_timestamp = pd.array(local_time.tz_convert("UTC").tz_localize(None).to_numpy(dtype="datetime64[ms]")
+                                  .astype(np.int64), dtype="Int64")
+    captured_timestamp[local_time.isna()] = pd.NA
+    events = pd.DataFrame({"longitude": location[:, 0], "latitude": location[:, 1],
+                           "captured_timestamp": captured_timestamp, "device_id": device_id,
+                           "journey_id": journey_id, "event_type": event_type, "journey_event": journey_event,
+                           "zip_code": pd.array(rng.integers(78701, 78760, len(rows)), dtype="Int32"),
+                           "data_point_id": ["p%d" % i for i in range(len(rows))]}, columns=EVENT_COLUMNS)
+    return events, bg_geometry, bg_ids
+
+def check_synthetic(n_devices=200, n_block_groups=100, seed=0):
+    """ Checks that the pipeline gives the vehicle_data of mylib on synthetic events.
+
+    The reference is computed with `mylib.timefeatures`,
+    `mylib.bgassign`, `mylib.tripbuild` and
+    `mylib.homeloc.rebuild_vehicle_data`. An AssertionError is raised if the
+    two differ.
+
+    Returns
+    -------
+    pd.DataFrame
+        vehicle_data of the synthetic events.
+
+    """
+
+    events, bg_geometry, bg_ids = synthetic_events(n_devices, n_block_groups, seed=seed)
+
+    start = time.perf_counter()
+    expected = add_time_features(events)
+    expected["bg_id"] = assign_bg(expected["longitude"], expected["latitude"], bg_geometry, bg_ids)
+    expected = rebuild_vehicle_data(build_trips(journey_events(expected)))
+    mylib_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "events.parquet")
+        events.to_parquet(path, index=False)
+        start = time.perf_counter()
+        vehicles = run_pipeline(path, (bg_geometry, bg_ids))
+        duckdb_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(vehicles, expected)
+    print(f"vehicle_data of {len(events)} events ({len(vehicles)} vehicles) is the same with DuckDB "
+          f"({duckdb_time:.1f} s) and mylib ({mylib_time:.1f} s)")
+    return vehicles
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the SQL_Commands.sql pipeline on DuckDB.")
+    parser.add_argument("--events", nargs="+", help="Parquet files of events.")
+    parser.add_argument("--block-groups", help="Block group layer with an AFFGEOID column.")
+    parser.add_argument("--database", default=":memory:", help="DuckDB database file to keep the tables in.")
+    parser.add_argument("--output", help="Parquet file to save vehicle_data in.")
+    parser.add_argument("--threads", type=int, help="Number of DuckDB threads.")
+    parser.add_argument("--check", action="store_true", help="Check the pipeline against mylib on synthetic events.")
+    args = parser.parse_args()
+
+    if args.check:
+        check_synthetic()
+    if args.events:
+        vehicle_data = run_pipeline(args.events, args.block_groups, database=args.database, threads=args.threads,
+                                    verbose=True)
+        print(vehicle_data)
+        if args.output is not None:
+            vehicle_data.to_parquet(args.output, index=False)
@@ -0,0 +1,210 @@
+""" Streaming ingestion of raw connected-vehicle events.
+
+The events are read as newline delimited JSON (one event per line,
+optionally gzip compressed) and all the fields used by SQL_Commands.sql
+are extracted in a single pass, in batches of bounded size, into typed
+columns:
+
+    longitude, latitude       data->'location'->>'longitude' / 'latitude'
+    captured_timestamp        data->>'capturedTimestamp' (epoch milliseconds)
+    device_id                 data->>'deviceId'
+    journey_id                data->>'journeyId'
+    event_type                data->'event'->>'eventType'
+    journey_event             data->'event'->'eventMetadata'->>'journeyEventType'
+    zip_code                  data->'location'->>'postalCode'
+    data_point_id             data->>'dataPointId'
+
+The batches can be written to Parquet or to a CSV file for COPY, so that the
+derived columns no longer need a full-table UPDATE each. In PostgreSQL:
+
+    \\copy driver_events FROM 'events.csv' WITH (FORMAT csv, HEADER)
+    -- loc_geom = ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)
+"""
+
+import gzip
+import json
+import numpy as np
+import pandas as pd
+
+EVENT_COLUMNS = ["longitude", "latitude", "captured_timestamp", "device_id", "journey_id",
+                 "event_type", "journey_event", "zip_code", "data_point_id"]
+
+def _open_events(path):
+    """ Opens a file of events for reading text, decompressing .gz files. """
+
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+def _to_int(value):
+    """ Converts a field to int, None if it is missing or not a number. """
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _events_frame(longitude, latitude, timestamp, device_id, journey_id, event_type, journey_event, zip_code,
+                  data_point_id):
+    """ Builds a batch of typed columns from the lists of extracted fields. """
+
+    return pd.DataFrame({
+        "longitude": np.array(longitude, dtype=np.float64),
+        "latitude": np.array(latitude, dtype=np.float64),
+        "captured_timestamp": pd.array(timestamp, dtype="Int64"),
+        "device_id": device_id,
+        "journey_id": journey_id,
+        "event_type": event_type,
+        "journey_event": journey_event,
+        "zip_code": pd.array(zip_code, dtype="Int32"),
+        "data_point_id": data_point_id}, columns=EVENT_COLUMNS)
+
+def iter_event_batches(path, batch_size=500000):
+    """ Reads the events of a file in batches.
+
+    Blank lines are skipped. Missing fields are left missing (NaN, <NA> or
+    None) rather than failing the batch.
+
+    Parameters
+    ----------
+    path : str
+        Newline delimited JSON file of events, optionally ending in .gz.
+    batch_size : int, optional
+        Maximum number of events in each batch.
+
+    Yields
+    ------
+    pd.DataFrame
+        Batch of events with the columns in `EVENT_COLUMNS`.
+
+    """
+
+    columns = [list() for _ in EVENT_COLUMNS]
+    (longitude, latitude, timestamp, device_id, journey_id,
+     event_type, journey_event, zip_code, data_point_id) = columns
+    with _open_events(path) as events:
+        for line in events:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            location = event.get("location") or {}
+            event_info = event.get("event") or {}
+            metadata = event_info.get("eventMetadata") or {}
+            longitude.append(location.get("longitude", np.nan))
+            latitude.append(location.get("latitude", np.nan))
+            timestamp.append(_to_int(event.get("capturedTimestamp")))
+            device_id.append(event.get("deviceId"))
+            journey_id.append(event.get("journeyId"))
+            event_type.append(event_info.get("eventType"))
+            journey_event.append(metadata.get("journeyEventType"))
+            zip_code.append(_to_int(location.get("postalCode")))
+            data_point_id.append(event.get("dataPointId"))
+            if len(longitude) == batch_size:
+                yield _events_frame(*columns)
+                for column in columns:
+                    column.clear()
+    if longitude:
+        yield _events_frame(*columns)
+
+def write_events_parquet(path, output_path, batch_size=500000):
+    """ Converts a file of events to a Parquet file, one row group per batch.
+
+    Returns
+    -------
+    int
+        Number of events written.
+
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([("longitude", pa.float64()), ("latitude", pa.float64()),
+                        ("captured_timestamp", pa.int64()), ("device_id", pa.string()),
+                        ("journey_id", pa.string()), ("event_type", pa.string()),
+                        ("journey_event", pa.string()),
+                        ("zip_code", pa.int32()), ("data_point_id", pa.string())])
+    n_events = 0
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for batch in iter_event_batches(path, batch_size):
+            writer.write_table(pa.Table.from_pandas(batch, schema=schema, preserve_index=False))
+            n_events += len(batch)
+    return n_events
+
+def write_events_copy(path, output_path, batch_size=500000):
+    """ Converts a file of events to a CSV file with a header for COPY.
+
+    Missing values are written as empty fields, which COPY in csv format
+    loads as NULL.
+
+    Returns
+    -------
+    int
+        Number of events written.
+
+    """
+
+    n_events = 0
+    with open(output_path, "w", newline="", encoding="utf-8") as output:
+        for batch in iter_event_batches(path, batch_size):
+            batch.to_csv(output, header=n_events == 0, index=False, float_format="%.7f")
+            n_events += len(batch)
+    return n_events
+
+def test_iter_event_batches():
+    """ Tests reading events with missing fields and writing them out typed. """
+
+    import os
+    import tempfile
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    print("Testing iter_event_batches.")
+    events = [{"dataPointId": "p0", "deviceId": "d0", "journeyId": "j0", "capturedTimestamp": "1583650800123",
+               "location": {"longitude": -97.7431, "latitude": 30.2672, "postalCode": "78701"},
+               "event": {"eventType": "IGNITION_ON", "eventMetadata": {"journeyEventType": "START"}}},
+              {"dataPointId": "p1", "deviceId": "d0", "capturedTimestamp": 1583650900000, "location": None, "event": None},
+              {"dataPointId": "p2", "deviceId": "d1", "location": {"latitude": 30.5}, "event": {"eventType": "MOVING"}},
+              {"dataPointId": "p3", "capturedTimestamp": "not a time", "location": {"postalCode": None},
+               "event": {"eventType": "IGNITION_OFF", "eventMetadata": None}}]
+    with tempfile.TemporaryDirectory() as folder:
+        # Gzip compressed, with blank lines between and after the events
+        path = os.path.join(folder, "events.json.gz")
+        with gzip.open(path, "wt", encoding="utf-8") as events_file:
+            events_file.write("".join(json.dumps(event) + "\n  \n" for event in events) + "\n")
+        batch, = iter_event_batches(path)
+        assert list(batch.columns) == EVENT_COLUMNS and list(batch["data_point_id"]) == ["p0", "p1", "p2", "p3"]
+        assert list(batch["captured_timestamp"].fillna(-1)) == [1583650800123, 1583650900000, -1, -1]
+        assert list(batch["zip_code"].fillna(-1)) == [78701, -1, -1, -1]
+        assert batch["longitude"].isna().tolist() == [False, True, True, True]
+        assert batch["latitude"].isna().tolist() == [False, True, False, True]
+        assert batch["event_type"].fillna("").tolist() == ["IGNITION_ON", "", "MOVING", "IGNITION_OFF"]
+        assert batch["journey_event"].fillna("").tolist() == ["START", "", "", ""]
+        assert batch["device_id"].fillna("").tolist() == ["d0", "d0", "d1", ""]
+
+        # Batches of exactly batch_size events, with no empty batch at the end
+        assert [len(batch) for batch in iter_event_batches(path, batch_size=2)] == [2, 2]
+        assert [len(batch) for batch in iter_event_batches(path, batch_size=3)] == [3, 1]
+
+        # The Parquet and COPY outputs keep the integer columns and the missing values
+        parquet_path = os.path.join(folder, "events.parquet")
+        assert write_events_parquet(path, parquet_path, batch_size=3) == len(events)
+        assert pq.ParquetFile(parquet_path).num_row_groups == 2
+        table = pq.read_table(parquet_path)
+        assert table.schema.field("captured_timestamp").type == pa.int64()
+        assert table.schema.field("zip_code").type == pa.int32()
+        assert table.column("captured_timestamp").to_pylist() == [1583650800123, 1583650900000, None, None]
+        assert table.column("zip_code").to_pylist() == [78701, None, None, None]
+        assert table.column("journey_event").to_pylist() == ["START", None, None, None]
+        copy_path = os.path.join(folder, "events.csv")
+        assert write_events_copy(path, copy_path, batch_size=3) == len(events)
+        with open(copy_path, encoding="utf-8") as copy_file:
+            lines = copy_file.read().splitlines()
+        assert lines == [",".join(EVENT_COLUMNS),
+                         "-97.7431000,30.2672000,1583650800123,d0,j0,IGNITION_ON,START,78701,p0",
+                         ",,1583650900000,d0,,,,,p1",
+                         ",30.5000000,,d1,,MOVING,,,p2",
+                         ",,,,,IGNITION_OFF,,,p3"]
+
+if __name__ == "__main__":
+    test_iter_event_batches()
@@ -0,0 +1,176 @@
+""" Incremental inference of the home block group of vehicles.
+
+Builds the vehicle_data table of SQL_Commands.sql: for each device, the
+block group where it stayed the longest in total and the one where it
+stayed the longest over nights (stays covering 3 AM). Only devices with
+both are kept.
+
+`HomeLocations` keeps the stay sums of every device and block group so that
+new weeks of trips can be added without recomputing the old ones. The stay
+after the last trip of a device depends on its next trip, so the last trip
+of each device is kept pending until newer trips arrive. Sums are kept in
+integer microseconds, so the result is the same as a rebuild from all the
+trips, which `rebuild_vehicle_data` computes.
+
+Ties in stay duration, left to the database by the SQL, are broken by the
+lowest block group id.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+from mylib.staycalc import compute_stays
+from mylib.tripbuild import TRIP_COLUMNS
+
+VEHICLE_COLUMNS = ["device_id", "tot_stay_duration", "tot_stay_bg_id", "night_stay_duration", "night_stay_bg_id"]
+
+_MICROSECOND = pd.Timedelta(microseconds=1)
+
+def _stay_sums(stays):
+    """ Sums the total and overnight stay durations by device and block group. """
+
+    stays = stays.loc[stays["stay_duration"].notna()]
+    duration = (stays["stay_duration"] // _MICROSECOND).to_numpy(dtype=np.int64)
+    overnight = stays["overnight_stay"].to_numpy(dtype=bool, na_value=False)
+    sums = pd.DataFrame({"device_id": stays["device_id"].to_numpy(), "bg_id": stays["next_bg_id"].to_numpy(),
+                         "tot_us": duration, "night_us": np.where(overnight, duration, 0)})
+    return sums.groupby(["device_id", "bg_id"], sort=False, as_index=False).sum()
+
+def vehicle_frame(rows):
+    """ Builds vehicle_data from (device, tot_us, tot_bg, night_us, night_bg) rows.
+
+    The durations are given in integer microseconds. The rows are sorted by
+    device and have the `VEHICLE_COLUMNS`.
+
+    """
+
+    vehicles = pd.DataFrame(rows, columns=["device_id", "tot_us", "tot_stay_bg_id", "night_us", "night_stay_bg_id"])
+    vehicles["tot_stay_duration"] = pd.to_timedelta(vehicles["tot_us"].astype(np.int64), unit="us")
+    vehicles["night_stay_duration"] = pd.to_timedelta(vehicles["night_us"].astype(np.int64), unit="us")
+    return vehicles.sort_values("device_id", kind="stable")[VEHICLE_COLUMNS].reset_index(drop=True)
+
+def rebuild_vehicle_data(trips, n_jobs=1):
+    """ Computes vehicle_data from all the trips at once, as in the SQL.
+
+    Parameters
+    ----------
+    trips : pd.DataFrame
+        Trips as returned by `mylib.tripbuild.build_trips`.
+    n_jobs : int, optional
+        Number of processes for `mylib.staycalc.compute_stays`.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per device with the `VEHICLE_COLUMNS`.
+
+    """
+
+    sums = _stay_sums(compute_stays(trips, n_jobs=n_jobs))
+    top = list()
+    for column in ("tot_us", "night_us"):
+        ranked = sums.loc[sums[column] > 0] if column == "night_us" else sums
+        ranked = ranked.sort_values([column, "bg_id"], ascending=[False, True], kind="stable")
+        top.append(ranked.drop_duplicates("device_id")[["device_id", column, "bg_id"]])
+    vehicles = top[0].merge(top[1], on="device_id", suffixes=("_tot", "_night"))
+    return vehicle_frame(vehicles[["device_id", "tot_us", "bg_id_tot", "night_us", "bg_id_night"]].to_numpy())
+
+class HomeLocations:
+    """ Running stay sums of vehicles by block group.
+
+    Use `update` with each new batch of trips and `vehicle_data` to get the
+    home block groups. The trips of a device in a batch must all start after
+    the trips of that device in the earlier batches.
+
+    """
+
+    def __init__(self):
+        # device_id -> {bg_id: [total microseconds, overnight microseconds]}
+        self._sums = dict()
+        # device_id -> (tot_us, tot_bg_id, night_us, night_bg_id)
+        self._top = dict()
+        self._pending = pd.DataFrame(columns=TRIP_COLUMNS)
+
+    def update(self, trips, n_jobs=1):
+        """ Adds the stays of a new batch of trips.
+
+        Only the sums of the devices with new trips are updated.
+
+        Parameters
+        ----------
+        trips : pd.DataFrame
+            New trips as returned by `mylib.tripbuild.build_trips`.
+        n_jobs : int, optional
+            Number of processes for `mylib.staycalc.compute_stays`.
+
+        Returns
+        -------
+        HomeLocations
+            This object.
+
+        """
+
+        trips = trips[TRIP_COLUMNS]
+        if len(trips) == 0:
+            return self
+        devices = trips["device_id"].unique()
+        is_updated = self._pending["device_id"].isin(devices)
+        pending = self._pending.loc[is_updated]
+        first_start = trips.groupby("device_id")["start_time"].min()
+        if (pending["start_time"].to_numpy() >= first_start.reindex(pending["device_id"]).to_numpy()).any():
+            raise ValueError("The new trips of a device must start after its earlier trips.")
+
+        stays = compute_stays(pd.concat([pending, trips], ignore_index=True) if len(pending) else trips, n_jobs=n_jobs)
+        is_last = ~stays["device_id"].duplicated(keep="last").to_numpy()
+        kept = self._pending.loc[~is_updated]
+        self._pending = stays.loc[is_last, TRIP_COLUMNS].reset_index(drop=True)
+        if len(kept):
+            self._pending = pd.concat([kept, self._pending], ignore_index=True)
+
+        for device_id, bg_id, tot_us, night_us in _stay_sums(stays.loc[~is_last]).itertuples(index=False):
+            sums = self._sums.setdefault(device_id, dict()).setdefault(bg_id, [0, 0])
+            sums[0] += int(tot_us)
+            sums[1] += int(night_us)
+        for device_id in devices:
+            if device_id in self._sums:
+                self._top[device_id] = self._device_top(self._sums[device_id])
+        return self
+
+    @staticmethod
+    def _device_top(sums):
+        """ Finds the block groups with the longest total and overnight stays. """
+
+        tot_bg = min(sums, key=lambda bg_id: (-sums[bg_id][0], bg_id))
+        night = [bg_id for bg_id in sums if sums[bg_id][1] > 0]
+        night_bg = min(night, key=lambda bg_id: (-sums[bg_id][1], bg_id)) if night else None
+        return sums[tot_bg][0], tot_bg, sums[night_bg][1] if night else None, night_bg
+
+    def vehicle_data(self):
+        """ Returns the home block groups of the devices, as vehicle_data. """
+
+        return vehicle_frame([(device_id,) + top for device_id, top in self._top.items() if top[3] is not None])
+
+    def save(self, folder):
+        """ Saves the stay sums and the pending trips as Parquet files in `folder`. """
+
+        os.makedirs(folder, exist_ok=True)
+        rows = [(device_id, bg_id, tot_us, night_us) for device_id, sums in self._sums.items()
+                for bg_id, (tot_us, night_us) in sums.items()]
+        sums = pd.DataFrame(rows, columns=["device_id", "bg_id", "tot_us", "night_us"])
+        sums.astype({"tot_us": np.int64, "night_us": np.int64}).to_parquet(os.path.join(folder, "stay_sums.parquet"),
+                                                                           index=False)
+        self._pending.to_parquet(os.path.join(folder, "pending_trips.parquet"), index=False)
+
+    @classmethod
+    def load(cls, folder):
+        """ Loads the stay sums and the pending trips saved with `save`. """
+
+        home_locations = cls()
+        sums = pd.read_parquet(os.path.join(folder, "stay_sums.parquet"))
+        for device_id, bg_id, tot_us, night_us in sums.itertuples(index=False):
+            home_locations._sums.setdefault(device_id, dict())[bg_id] = [int(tot_us), int(night_us)]
+        for device_id, device_sums in home_locations._sums.items():
+            home_locations._top[device_id] = cls._device_top(device_sums)
+        home_locations._pending = pd.read_parquet(os.path.join(folder, "pending_trips.parquet"))
+        return home_locations
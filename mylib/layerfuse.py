@@ -1,6 +1,13 @@
 import pandas as pd
 import numpy as np
 import geopandas as gpd
+import shapely
+import scipy.sparse
+import hashlib
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
 
 __title__ = 'Layer Fuse'
@@ -9,8 +16,10 @@ __author__ = 'Gopindra Sivakumar Nair'
 __license__ = 'MIT'
 __copyright__ = '2020 by Gopindra Sivakumar Nair'
 
+_MEMORY_FACTOR = 8
 
-def layerfuse(into_layer, from_layer, size_cols=[], density_cols=[], show_overlap=False):
+def layerfuse(into_layer, from_layer, size_cols=[], density_cols=[], show_overlap=False,
+              method="vectorized", n_jobs=1, memory_budget=None, partition_by=None, cache_dir=None):
     
     """ Merges attributes of GeoDataFrame based on overlap between polygons.
     
@@ -36,6 +45,32 @@ def layerfuse(into_layer, from_layer, size_cols=[], density_cols=[], show_overla
         underestimate since the contributions from the non-overlapping portions
         are not added. A possible fix would be to later, divide the merged
         attribute columns with the values in "_OVERLAP" column.
+    method: {"vectorized", "loop"}, optional
+        How the overlap areas are computed. "vectorized" computes all the
+        intersections in bulk over geometry arrays. "loop" is the original
+        polygon by polygon computation and is kept for comparison.
+    n_jobs: int, optional
+        Number of processes to use. If greater than 1 or if `memory_budget` is
+        set, `into_layer` is split spatially into partitions which are fused
+        separately. The result is identical to the single process result. On
+        Windows, the calling script should be guarded with
+        `if __name__ == "__main__":`.
+    memory_budget: int, optional
+        Approximate memory in bytes available for the fusing across all the
+        processes. More partitions are used when the layers are too large to
+        fit within the budget.
+    partition_by: column index, optional
+        Column of `into_layer` to use as the partitions (eg. county) instead
+        of a spatial grid. Every polygon must have a partition; a ValueError
+        is raised if the column has missing values.
+    cache_dir: str, optional
+        Folder where the overlap weights between the two layers are stored.
+        The weights are computed once for a pair of layers (identified by their
+        geometries and CRS) and later calls with the same layers only apply
+        the stored weights to the attributes. See `overlap_weights`. The
+        weights are cached for the whole layers only, so `cache_dir` cannot
+        be combined with `n_jobs`, `memory_budget` or `partition_by`; a
+        ValueError is raised if it is.
     
     Returns
     -------
@@ -45,31 +80,297 @@ def layerfuse(into_layer, from_layer, size_cols=[], density_cols=[], show_overla
     """
     
     from_layer = from_layer.filter(size_cols + density_cols + [from_layer.geometry.name])
-    sjoin = gpd.sjoin(gpd.GeoDataFrame(geometry=into_layer.geometry), from_layer)
-    sjoin = sjoin.reset_index()
     
-    into_fraction = pd.Series(np.zeros(sjoin.shape[0]), index=sjoin.index)
-    from_fraction = pd.Series(np.zeros(sjoin.shape[0]), index=sjoin.index)
+    partitioned = n_jobs != 1 or memory_budget is not None or partition_by is not None
+    if cache_dir is not None and partitioned:
+        raise ValueError("cache_dir cannot be combined with n_jobs, memory_budget or partition_by.")
     
-    for index in sjoin.index:
-        into_poly = sjoin.geometry[index]
-        from_poly = from_layer.geometry[sjoin.loc[index, "index_right"]]
-        intersection = into_poly.intersection(from_poly)
-        into_fraction[index] = intersection.area/into_poly.area
-        from_fraction[index] = intersection.area/from_poly.area
-        
-    sjoin[density_cols] = sjoin[density_cols].multiply(into_fraction, axis=0)
-    sjoin[size_cols] = sjoin[size_cols].multiply(from_fraction, axis=0)
+    if not partitioned:
+        fused_attributes = _fuse_attributes(into_layer.geometry, from_layer, size_cols, density_cols, show_overlap, method,
+                                            cache_dir)
+    else:
+        partitions = into_layer[partition_by] if partition_by is not None else None
+        fused_attributes = _fuse_partitioned(into_layer.geometry, from_layer, size_cols, density_cols, show_overlap, method,
+                                             n_jobs, memory_budget, partitions)
+    
+    fused_layer = gpd.GeoDataFrame(into_layer.copy(), crs=into_layer.crs)
+    for column, values in fused_attributes.items():
+        fused_layer[column] = values
+
+    return(fused_layer)
+
+def overlap_weights(into_layer, from_layer, method="vectorized", cache_dir=None):
+    """ Computes the overlap weights between the polygons of two layers.
+    
+    The weights are returned as sparse matrices with one row for each polygon
+    in `into_layer` and one column for each polygon in `from_layer`. The
+    attributes fused by `layerfuse` are then products of these matrices with
+    the attribute columns of `from_layer`.
+    
+    Parameters
+    ----------
+    into_layer : gpd.GeoDataFrame or gpd.GeoSeries
+        The layer into which the attributes will be added.
+    from_layer : gpd.GeoDataFrame or gpd.GeoSeries
+        The layer from which the attributes will be taken.
+    method: {"vectorized", "loop"}, optional
+        See `layerfuse`.
+    cache_dir: str, optional
+        If given, the weights are loaded from this folder when they have been
+        computed before for the same geometries and CRS of both layers.
+        Otherwise they are computed and saved here. A cache file that cannot
+        be read, eg. after an interrupted write, is computed again.
+    
+    Returns
+    -------
+    into_weights : scipy.sparse.csr_matrix
+        Area of overlap as a fraction of the area of the `into_layer` polygon.
+    from_weights : scipy.sparse.csr_matrix
+        Area of overlap as a fraction of the area of the `from_layer` polygon.
+    
+    """
+    
+    into_geometry = into_layer.geometry
+    from_geometry = from_layer.geometry
+    shape = (len(into_geometry), len(from_geometry))
+    
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, "overlap_%s.npz" % _weights_key(into_geometry, from_geometry))
+        cached = _read_cached_weights(cache_file)
+        if cached is not None:
+            return (_weights_matrix(cached["into_position"], cached["from_position"], cached["into_fraction"], shape),
+                    _weights_matrix(cached["into_position"], cached["from_position"], cached["from_fraction"], shape))
+    
+    into_position, from_position = _overlap_pairs(into_geometry, from_geometry)
+    into_geoms = into_geometry.values[into_position]
+    from_geoms = from_geometry.values[from_position]
+    if method == "vectorized":
+        into_fraction, from_fraction = _overlap_fractions(into_geoms, from_geoms)
+    elif method == "loop":
+        into_fraction, from_fraction = _overlap_fractions_loop(into_geoms, from_geoms)
+    else:
+        raise ValueError(f'Unknown method "{method}". Use "vectorized" or "loop".')
+    
+    if cache_dir is not None:
+        _write_cached_weights(cache_file, into_position=into_position, from_position=from_position,
+                              into_fraction=into_fraction, from_fraction=from_fraction)
+    
+    return (_weights_matrix(into_position, from_position, into_fraction, shape),
+            _weights_matrix(into_position, from_position, from_fraction, shape))
+
+def _read_cached_weights(cache_file):
+    """ Arrays of a cache file of overlap weights, None if missing or unreadable. """
     
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cached:
+            return {name: cached[name] for name in ("into_position", "from_position", "into_fraction", "from_fraction")}
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return None
+
+def _write_cached_weights(cache_file, **arrays):
+    """ Saves the arrays of overlap weights, replacing the cache file at once.
+    
+    The arrays are written to a temporary file in the same folder first, so
+    that an interrupted write or another process saving the same weights
+    never leaves a partial cache file.
+    
+    """
+    
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    descriptor, temporary_file = tempfile.mkstemp(dir=cache_dir, suffix=".npz.tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as temporary:
+            np.savez(temporary, **arrays)
+        os.replace(temporary_file, cache_file)
+    except BaseException:
+        os.remove(temporary_file)
+        raise
+
+def _overlap_pairs(into_geometry, from_geometry):
+    """ Positions of the intersecting polygons, sorted by into and from position. """
+    
+    into_position, from_position = from_geometry.sindex.query(into_geometry, predicate="intersects")
+    order = np.lexsort((from_position, into_position))
+    return into_position[order], from_position[order]
+
+def _weights_matrix(into_position, from_position, fraction, shape):
+    """ Sparse matrix of overlap fractions. """
+    
+    # Fractions are not defined for polygons with no area. Like the missing
+    # values skipped while summing, these do not contribute to the attributes.
+    fraction = np.nan_to_num(fraction, nan=0.0)
+    return scipy.sparse.csr_matrix((fraction, (into_position, from_position)), shape=shape)
+
+def _weights_key(into_geometry, from_geometry):
+    """ Hash identifying the geometries and CRS of a pair of layers. """
+    
+    hasher = hashlib.sha1()
+    for geometry in (into_geometry, from_geometry):
+        hasher.update(("None" if geometry.crs is None else geometry.crs.to_wkt()).encode())
+        hasher.update(str(len(geometry)).encode())
+        hasher.update(b"".join(shapely.to_wkb(np.asarray(geometry, dtype=object))))
+    return hasher.hexdigest()
+
+def _apply_weights(into_weights, from_weights, from_layer, size_cols, density_cols, show_overlap):
+    """ Computes the fused attributes from the overlap weights.
+    
+    Only `size_cols`, `density_cols` and "_OVERLAP" are aggregated, each as a
+    sparse matrix product. Missing attribute values are skipped in the sums.
+    
+    Returns
+    -------
+    dict
+        Column name to array of fused values for every polygon of the
+        `into_layer`. Polygons that do not overlap `from_layer` get np.nan.
+    
+    """
+    
+    no_overlap = into_weights.getnnz(axis=1) == 0
+    fused_attributes = dict()
+    for columns, weights in ((size_cols, from_weights), (density_cols, into_weights)):
+        if len(columns) == 0:
+            continue
+        values = weights @ from_layer[columns].fillna(0).to_numpy(dtype=np.float64)
+        values[no_overlap] = np.nan
+        fused_attributes.update(zip(columns, values.T))
     if show_overlap:
-        sjoin["_OVERLAP"] = into_fraction
+        overlap = np.asarray(into_weights.sum(axis=1)).ravel()
+        overlap[no_overlap] = np.nan
+        fused_attributes["_OVERLAP"] = overlap
     
-    index_name = "index" if into_layer.index.name is None else into_layer.index.name
-    fused_layer = sjoin.groupby(index_name).agg(sum)
-    fused_layer = fused_layer.drop(["index_right"], axis=1)
-    fused_layer = gpd.GeoDataFrame(into_layer.merge(fused_layer, how="left", left_index=True, right_index=True), crs=into_layer.crs)
+    return fused_attributes
 
-    return(fused_layer)
+def _fuse_attributes(into_geometry, from_layer, size_cols, density_cols, show_overlap, method, cache_dir=None):
+    """ Computes the fused attributes for the polygons in `into_geometry`.
+    
+    See `layerfuse` for the parameters and `_apply_weights` for the returned
+    value.
+    
+    """
+    
+    into_weights, from_weights = overlap_weights(into_geometry, from_layer, method=method, cache_dir=cache_dir)
+    return _apply_weights(into_weights, from_weights, from_layer, size_cols, density_cols, show_overlap)
+
+def _fuse_partitioned(into_geometry, from_layer, size_cols, density_cols, show_overlap, method,
+                      n_jobs, memory_budget, partitions=None):
+    """ Computes the fused attributes partition by partition.
+    
+    `into_geometry` is split spatially into partitions and each partition is
+    fused only with the polygons in `from_layer` that fall within its bounds.
+    The partitions are processed across a pool of `n_jobs` processes. Since
+    every polygon in `into_geometry` belongs to exactly one partition, the
+    partial results are written into the rows of that partition.
+    
+    Parameters
+    ----------
+    partitions : pd.Series, optional
+        Partition label of each polygon in `into_geometry` (eg. county). If
+        None, the polygons are partitioned on a grid whose size is chosen
+        based on `n_jobs` and `memory_budget`.
+    
+    See `layerfuse` for the remaining parameters.
+    
+    """
+    
+    if partitions is None:
+        n_partitions = n_jobs
+        if memory_budget is not None:
+            # Each of the workers holds one partition in memory at a time
+            required_memory = _estimate_memory(into_geometry) + _estimate_memory(from_layer.geometry)
+            n_partitions = max(n_partitions, int(np.ceil(required_memory * n_jobs / memory_budget)))
+        partitions = _grid_partitions(into_geometry, n_partitions)
+    elif pd.isna(partitions).any():
+        raise ValueError(f"{pd.isna(partitions).sum()} polygons have no partition. Fill the missing values of the `partition_by` column.")
+    partitions = np.asarray(partitions)
+    
+    tasks = list()
+    task_positions = list()
+    for partition in pd.unique(partitions):
+        into_positions = np.flatnonzero(partitions == partition)
+        into_part = into_geometry.iloc[into_positions]
+        from_positions = np.sort(from_layer.sindex.query(shapely.box(*into_part.total_bounds)))
+        from_part = from_layer.iloc[from_positions]
+        tasks.append((into_part, from_part, size_cols, density_cols, show_overlap, method))
+        task_positions.append(into_positions)
+    
+    if n_jobs == 1:
+        fused_parts = [_fuse_attributes(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            fused_parts = list(executor.map(_fuse_attributes, *zip(*tasks)))
+    
+    columns = size_cols + density_cols + (["_OVERLAP"] if show_overlap else [])
+    fused_attributes = {column: np.full(len(into_geometry), np.nan) for column in columns}
+    for into_positions, fused_part in zip(task_positions, fused_parts):
+        for column, values in fused_part.items():
+            fused_attributes[column][into_positions] = values
+    
+    return fused_attributes
+
+def _grid_partitions(geometry, n_partitions):
+    """ Assigns polygons to cells of a grid with about `n_partitions` cells.
+    
+    The grid lines are placed at quantiles of the representative points of
+    the polygons so that the cells have similar number of polygons.
+    
+    """
+    
+    n_side = int(np.ceil(np.sqrt(n_partitions)))
+    points = geometry.representative_point()
+    quantiles = np.linspace(0, 1, n_side + 1)[1:-1]
+    column = np.digitize(points.x, np.quantile(points.x, quantiles))
+    row = np.digitize(points.y, np.quantile(points.y, quantiles))
+    return row * n_side + column
+
+def _estimate_memory(geometry):
+    """ Rough estimate of the memory in bytes needed to fuse `geometry`. """
+    
+    # Coordinates are stored as 16 bytes per vertex. The factor accounts for
+    # the copies made by the spatial join and the intersections.
+    return int(shapely.get_num_coordinates(np.asarray(geometry, dtype=object)).sum()) * 16 * _MEMORY_FACTOR
+
+def _overlap_fractions(into_geoms, from_geoms):
+    """ Computes overlap fractions for paired polygons in bulk.
+    
+    Parameters
+    ----------
+    into_geoms : array of shapely geometries
+        Polygons from the `into_layer`.
+    from_geoms : array of shapely geometries
+        Polygons from the `from_layer`, paired element-wise with `into_geoms`.
+    
+    Returns
+    -------
+    into_fraction : np.ndarray
+        Area of intersection as a fraction of the area of `into_geoms`.
+    from_fraction : np.ndarray
+        Area of intersection as a fraction of the area of `from_geoms`.
+    
+    """
+    
+    into_geoms = np.asarray(into_geoms, dtype=object)
+    from_geoms = np.asarray(from_geoms, dtype=object)
+    intersection_area = shapely.area(shapely.intersection(into_geoms, from_geoms))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        into_fraction = intersection_area/shapely.area(into_geoms)
+        from_fraction = intersection_area/shapely.area(from_geoms)
+    return into_fraction, from_fraction
+
+def _overlap_fractions_loop(into_geoms, from_geoms):
+    """ Same as `_overlap_fractions` but computed one pair at a time. """
+    
+    into_fraction = np.zeros(len(into_geoms))
+    from_fraction = np.zeros(len(into_geoms))
+    
+    for index, (into_poly, from_poly) in enumerate(zip(into_geoms, from_geoms)):
+        intersection = into_poly.intersection(from_poly)
+        into_fraction[index] = intersection.area/into_poly.area
+        from_fraction[index] = intersection.area/from_poly.area
+    
+    return into_fraction, from_fraction
 
 def test_layerfuse():
     """ Tests the layerfuse function """
@@ -113,6 +414,55 @@ def test_layerfuse():
     # Note that third polygon in geodatB is not completely overlapped by geodatA.
     
     fused_layer = layerfuse(geodatB, geodatA, size_cols=["x"], density_cols=["y"], show_overlap=True)
+    
+    # The vectorized and the loop computations should give identical results
+    fused_layer_loop = layerfuse(geodatB, geodatA, size_cols=["x"], density_cols=["y"], show_overlap=True, method="loop")
+    pd.testing.assert_frame_equal(pd.DataFrame(fused_layer.drop(columns="geometry")),
+                                  pd.DataFrame(fused_layer_loop.drop(columns="geometry")))
+    
+    # Fusing with cached overlap weights should give the same results, both
+    # when the weights are computed and when they are read back
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for _ in range(2):
+            fused_layer_cached = layerfuse(geodatB, geodatA, size_cols=["x"], density_cols=["y"], show_overlap=True, cache_dir=cache_dir)
+            pd.testing.assert_frame_equal(pd.DataFrame(fused_layer.drop(columns="geometry")),
+                                          pd.DataFrame(fused_layer_cached.drop(columns="geometry")))
+        
+        # A truncated cache file is computed and saved again
+        cache_file, = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+        with open(cache_file, "r+b") as truncated:
+            truncated.truncate(os.path.getsize(cache_file) // 2)
+        for _ in range(2):
+            fused_layer_cached = layerfuse(geodatB, geodatA, size_cols=["x"], density_cols=["y"], show_overlap=True, cache_dir=cache_dir)
+            pd.testing.assert_frame_equal(pd.DataFrame(fused_layer.drop(columns="geometry")),
+                                          pd.DataFrame(fused_layer_cached.drop(columns="geometry")))
+        assert _read_cached_weights(cache_file) is not None and os.listdir(cache_dir) == [os.path.basename(cache_file)]
+    
+    # The cached weights are only for single process runs
+    try:
+        layerfuse(geodatB, geodatA, size_cols=["x"], n_jobs=2, cache_dir=tempfile.gettempdir())
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("cache_dir with n_jobs should raise a ValueError.")
+    
+    # Fusing partition by partition, in one or several processes, should give
+    # exactly the results of the single process
+    geodatB["part"] = ["a", "a", "b"]
+    for kwargs in [{"partition_by": "part"}, {"memory_budget": 1}, {"n_jobs": 2}, {"n_jobs": 2, "partition_by": "part"}]:
+        fused_layer_partitioned = layerfuse(geodatB, geodatA, size_cols=["x"], density_cols=["y"], show_overlap=True, **kwargs)
+        pd.testing.assert_frame_equal(pd.DataFrame(fused_layer.drop(columns="geometry")),
+                                      pd.DataFrame(fused_layer_partitioned.drop(columns=["geometry", "part"])))
+    
+    # Polygons without a partition are not silently left out
+    geodatB["part"] = ["a", None, "b"]
+    try:
+        layerfuse(geodatB, geodatA, size_cols=["x"], density_cols=["y"], partition_by="part")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Polygons without a partition should raise a ValueError.")
+    geodatB = geodatB.drop(columns="part")
      
     print("Before correction")
     print(fused_layer)
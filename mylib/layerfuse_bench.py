@@ -0,0 +1,275 @@
+""" Benchmarks for mylib.layerfuse on synthetic polygon layers.
+
+The layers are tessellations (square grids, offset hexagons and random
+Voronoi cells) of the same square, so fusing one into another should
+conserve the total of every size column. With the area of each polygon as
+the size column, the fused value of each polygon is its own area.
+
+Run as a script from the repository root:
+    python -m mylib.layerfuse_bench --sizes 1000 10000
+"""
+
+import argparse
+import pandas as pd
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from mylib.layerfuse import overlap_weights, _apply_weights, _overlap_pairs, _overlap_fractions, _weights_matrix
+from mylib.runstats import measure
+
+
+def grid_layer(n_cols, n_rows, cell_size=1.0, origin=(0.0, 0.0)):
+    """ Generates a regular grid of square polygons.
+
+    Parameters
+    ----------
+    n_cols : int
+        Number of cells along x.
+    n_rows : int
+        Number of cells along y.
+    cell_size : float, optional
+        Length of the side of each cell.
+    origin : tuple of float, optional
+        Coordinates of the lower left corner of the grid.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Grid with a "size" column equal to the area of each cell and a
+        "density" column equal to 1.
+
+    """
+
+    x, y = np.meshgrid(np.arange(n_cols) * cell_size + origin[0], np.arange(n_rows) * cell_size + origin[1])
+    x, y = x.ravel(), y.ravel()
+    geometry = shapely.box(x, y, x + cell_size, y + cell_size)
+    return gpd.GeoDataFrame({"size": np.full(len(x), cell_size**2), "density": np.ones(len(x))}, geometry=geometry)
+
+def hexagon_layer(n_polygons, extent):
+    """ Generates offset hexagons covering a square, clipped to the square.
+
+    Parameters
+    ----------
+    n_polygons : int
+        Approximate number of hexagons.
+    extent : float
+        Length of the side of the square with its lower left corner at (0, 0).
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Hexagons with "size" and "density" columns as in `grid_layer`.
+
+    """
+
+    # Hexagon with circumradius r has an area of 1.5 * sqrt(3) * r^2
+    radius = np.sqrt(extent**2 / n_polygons / (1.5 * np.sqrt(3)))
+    width = np.sqrt(3) * radius
+    n_cols = int(np.ceil(extent / width)) + 2
+    n_rows = int(np.ceil(extent / (1.5 * radius))) + 2
+    col, row = np.meshgrid(np.arange(n_cols), np.arange(n_rows))
+    center_x = (col.ravel() - 1 + 0.5 * (row.ravel() % 2)) * width
+    center_y = (row.ravel() - 1) * 1.5 * radius
+    angles = np.radians(30 + 60 * np.arange(7))
+    coords = np.stack([center_x[:, None] + radius * np.cos(angles),
+                       center_y[:, None] + radius * np.sin(angles)], axis=-1)
+    return _clipped_layer(shapely.polygons(coords), extent)
+
+def voronoi_layer(n_polygons, extent, seed=0):
+    """ Generates Voronoi cells of random points in a square.
+
+    Parameters
+    ----------
+    n_polygons : int
+        Number of cells.
+    extent : float
+        Length of the side of the square with its lower left corner at (0, 0).
+    seed : int, optional
+        Seed for the random points.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Cells with "size" and "density" columns as in `grid_layer`.
+
+    """
+
+    points = np.random.default_rng(seed).uniform(0, extent, size=(n_polygons, 2))
+    cells = shapely.voronoi_polygons(shapely.multipoints(points), extend_to=shapely.box(0, 0, extent, extent))
+    return _clipped_layer(shapely.get_parts(cells), extent)
+
+def tessellation_layer(kind, n_polygons, extent):
+    """ Generates a "grid", "hexagon" or "voronoi" layer covering a square. """
+
+    if kind == "grid":
+        n_side = int(round(np.sqrt(n_polygons)))
+        return grid_layer(n_side, n_side, cell_size=extent / n_side)
+    elif kind == "hexagon":
+        return hexagon_layer(n_polygons, extent)
+    elif kind == "voronoi":
+        return voronoi_layer(n_polygons, extent)
+    else:
+        raise ValueError(f'Unknown tessellation "{kind}". Use "grid", "hexagon" or "voronoi".')
+
+def _clipped_layer(polygons, extent):
+    """ Clips polygons to the square and adds "size" and "density" columns. """
+
+    polygons = shapely.intersection(polygons, shapely.box(0, 0, extent, extent))
+    polygons = polygons[shapely.area(polygons) > 0]
+    return gpd.GeoDataFrame({"size": shapely.area(polygons), "density": np.ones(len(polygons))}, geometry=polygons)
+
+def _aggregate_groupby(into_weights, from_weights, from_layer, size_cols, density_cols, show_overlap):
+    """ The aggregation previously used by layerfuse, kept as a reference.
+
+    One row is created per overlapping pair with all the attribute columns
+    and the into/from positions, the attributes are weighted and then summed
+    with a groupby over the into positions.
+
+    """
+
+    into_weights = into_weights.tocoo()
+    from_weights = from_weights.tocoo()
+    pairs = from_layer.drop(columns=from_layer.geometry.name).iloc[from_weights.col].reset_index(drop=True)
+    pairs["index_right"] = from_weights.col
+    pairs["index"] = from_weights.row
+    pairs[density_cols] = pairs[density_cols].multiply(into_weights.data, axis=0)
+    pairs[size_cols] = pairs[size_cols].multiply(from_weights.data, axis=0)
+    if show_overlap:
+        pairs["_OVERLAP"] = into_weights.data
+    fused_attributes = pairs.groupby("index").agg("sum")
+    fused_attributes = fused_attributes.drop(["index_right"], axis=1)
+    return fused_attributes.reindex(np.arange(into_weights.shape[0]))
+
+def benchmark_aggregation(n_side=300, n_attributes=15):
+    """ Compares the groupby and the sparse aggregation of fused attributes.
+
+    An `n_side` x `n_side` grid is fused from a grid with cells of 1.5 times
+    the size, offset by half a cell, with `n_attributes` size columns. The
+    overlap weights are computed once and only the aggregation step is timed.
+
+    Returns
+    -------
+    pd.DataFrame
+        Wall time in seconds and peak memory in MB of each aggregation.
+
+    """
+
+    into_layer = grid_layer(n_side, n_side)
+    from_layer = grid_layer(int(n_side / 1.5) + 1, int(n_side / 1.5) + 1, cell_size=1.5, origin=(-0.5, -0.5))
+    size_cols = ["size_%d" % i for i in range(n_attributes)]
+    for column in size_cols:
+        from_layer[column] = from_layer["size"]
+    into_weights, from_weights = overlap_weights(into_layer, from_layer)
+
+    results = dict()
+    for name, aggregate in (("groupby", _aggregate_groupby), ("sparse", _apply_weights)):
+        fused, elapsed, peak = measure(aggregate, into_weights, from_weights, from_layer, size_cols, ["density"], True)
+        results[name] = {"seconds": elapsed, "peak_mb": peak / 2**20}
+        fused = pd.DataFrame(fused)
+        # The from grid covers the whole into grid, so the fused areas add up to
+        # the area of the into grid
+        assert np.allclose(fused[size_cols].sum(), n_side**2)
+
+    results = pd.DataFrame(results).T
+    print(f"Aggregation of {len(into_weights.data)} overlapping pairs with {n_attributes + 2} columns")
+    print(results)
+    return results
+
+def benchmark_stages(into_layer, from_layer, size_cols=["size"], density_cols=["density"]):
+    """ Times the stages of `layerfuse` and checks the conservation of mass.
+
+    The stages are the spatial join of the two layers (sjoin), the areas of
+    the intersections (intersection), the sparse weight matrices (weighting),
+    the aggregation of the attributes (groupby) and writing the attributes
+    into the output layer (merge).
+
+    Both layers are expected to cover the same area completely and to have
+    the area of each polygon in the "size" column.
+
+    Returns
+    -------
+    dict
+        Wall time in seconds and peak memory in MB of every stage, the
+        relative error in the total of the size columns ("mass_error") and the
+        largest relative difference between the fused "size" and the area of
+        the into polygons ("area_error").
+
+    """
+
+    results = dict()
+    def stage(name, function, *args):
+        result, elapsed, peak = measure(function, *args)
+        results[name + "_seconds"] = elapsed
+        results[name + "_peak_mb"] = peak / 2**20
+        return result
+
+    into_geometry = into_layer.geometry
+    from_geometry = from_layer.geometry
+    shape = (len(into_geometry), len(from_geometry))
+    into_position, from_position = stage("sjoin", _overlap_pairs, into_geometry, from_geometry)
+    into_fraction, from_fraction = stage("intersection", _overlap_fractions,
+                                         into_geometry.values[into_position], from_geometry.values[from_position])
+    into_weights, from_weights = stage("weighting", lambda: (_weights_matrix(into_position, from_position, into_fraction, shape),
+                                                              _weights_matrix(into_position, from_position, from_fraction, shape)))
+    fused_attributes = stage("groupby", _apply_weights, into_weights, from_weights, from_layer, size_cols, density_cols, True)
+
+    def merge():
+        fused_layer = gpd.GeoDataFrame(into_layer.drop(columns=size_cols + density_cols).copy(), crs=into_layer.crs)
+        for column, values in fused_attributes.items():
+            fused_layer[column] = values
+        return fused_layer
+    fused_layer = stage("merge", merge)
+
+    results["total_seconds"] = sum(value for key, value in results.items() if key.endswith("_seconds"))
+    results["pairs"] = len(into_position)
+    total = from_layer[size_cols].sum()
+    results["mass_error"] = float(((fused_layer[size_cols].sum() - total).abs() / total).max())
+    results["area_error"] = float(((fused_layer["size"] - into_layer["size"]).abs() / into_layer["size"]).max())
+    return results
+
+def run_suite(sizes=(1_000, 10_000, 100_000, 1_000_000),
+              layer_pairs=(("grid", "hexagon"), ("hexagon", "voronoi"), ("voronoi", "grid")),
+              tolerance=1e-6):
+    """ Runs `benchmark_stages` over tessellations of increasing size.
+
+    Each layer pair is fused at each size, with the from layer having half
+    as many polygons as the into layer. An AssertionError is raised if the
+    fused values are off from the analytic answer by more than `tolerance`.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row of results from `benchmark_stages` for each size and pair.
+
+    """
+
+    results = list()
+    for n_polygons in sizes:
+        extent = np.sqrt(n_polygons)
+        for into_kind, from_kind in layer_pairs:
+            into_layer = tessellation_layer(into_kind, n_polygons, extent)
+            from_layer = tessellation_layer(from_kind, n_polygons // 2, extent)
+            result = {"size": n_polygons, "into": into_kind, "from": from_kind}
+            result.update(benchmark_stages(into_layer, from_layer))
+            print(result)
+            assert result["mass_error"] < tolerance, f"Size is not conserved when fusing {from_kind} into {into_kind}"
+            assert result["area_error"] < tolerance, f"Fused areas are wrong when fusing {from_kind} into {into_kind}"
+            results.append(result)
+    return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark layerfuse on synthetic tessellations.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000],
+                        help="Number of polygons in the into layer.")
+    parser.add_argument("--output", help="CSV file to save the results in.")
+    parser.add_argument("--aggregation", action="store_true",
+                        help="Also compare the groupby and the sparse aggregation.")
+    args = parser.parse_args()
+
+    suite_results = run_suite(sizes=args.sizes)
+    print(suite_results)
+    if args.output is not None:
+        suite_results.to_csv(args.output, index=False)
+    if args.aggregation:
+        benchmark_aggregation()
@@ -0,0 +1,92 @@
+""" Writing of GIS layers for downstream loaders. """
+
+import os
+import geopandas as gpd
+
+
+def write_layer(layer, path, format="parquet", spatial_sort=True, row_group_size=50000):
+    """ Writes a layer as GeoParquet, Feather or Shapefile.
+
+    GeoParquet and Feather (Arrow IPC) keep the full column names and the
+    dtypes, and can be memory-mapped or read column by column. GeoParquet
+    files are written with a bounding box column, so that `read_layer` can
+    skip the row groups outside of a bounding box. The Shapefile
+    is kept as a legacy export: it truncates column names to 10 characters.
+
+    Parameters
+    ----------
+    layer : gpd.GeoDataFrame
+        Layer to write.
+    path : str
+        Path of the output file, without the extension.
+    format : str, optional
+        "parquet", "feather" or "shapefile".
+    spatial_sort : bool, optional
+        Whether to sort the rows along a Hilbert curve of the polygon
+        bounds, so that neighbouring polygons share row groups and bounding
+        box reads touch few of them.
+    row_group_size : int, optional
+        Number of rows per Parquet row group.
+
+    Returns
+    -------
+    str
+        Path of the written file.
+
+    """
+
+    if spatial_sort and len(layer) > 0:
+        layer = layer.iloc[layer.geometry.hilbert_distance().argsort(kind="stable")]
+    if format == "parquet":
+        path = path + ".parquet"
+        layer.to_parquet(path, index=False, row_group_size=row_group_size, write_covering_bbox=True)
+    elif format == "feather":
+        path = path + ".feather"
+        layer.reset_index(drop=True).to_feather(path)
+    elif format == "shapefile":
+        path = path + ".shp"
+        layer.to_file(path)
+    else:
+        raise ValueError(f'Unknown format "{format}". Use "parquet", "feather" or "shapefile".')
+    return path
+
+def read_layer(path, columns=None, bbox=None):
+    """ Reads a layer written by `write_layer`, optionally only some columns.
+
+    `bbox` (minx, miny, maxx, maxy) is only used for Parquet files, where
+    row groups outside of it are skipped with geopandas >= 1.0.
+
+    """
+
+    extension = os.path.splitext(path)[1]
+    if extension == ".parquet":
+        kwargs = dict() if bbox is None else {"bbox": bbox}
+        return gpd.read_parquet(path, columns=columns, **kwargs)
+    elif extension == ".feather":
+        return gpd.read_feather(path, columns=columns)
+    else:
+        return gpd.read_file(path, columns=columns, bbox=bbox)
+
+def test_write_layer():
+    """ Tests writing layers and reading them back, with a bounding box. """
+
+    import tempfile
+    import shapely
+
+    print("Testing write_layer.")
+    layer = gpd.GeoDataFrame({"long_column_name": range(100)},
+                             geometry=shapely.box(range(100), 0, [x + 1 for x in range(100)], 1), crs=3857)
+    with tempfile.TemporaryDirectory() as folder:
+        for format in ("parquet", "feather", "shapefile"):
+            path = write_layer(layer, os.path.join(folder, "layer"), format=format, row_group_size=10)
+            read = read_layer(path).sort_values(read_layer(path).columns[0]).reset_index(drop=True)
+            assert len(read) == len(layer)
+            assert read.geometry.geom_equals(layer.geometry).all()
+
+        # Only the polygons intersecting the bounding box are read
+        path = os.path.join(folder, "layer.parquet")
+        read = read_layer(path, columns=["long_column_name", "geometry"], bbox=(10.5, 0, 20.5, 1))
+        assert sorted(read["long_column_name"]) == list(range(10, 21))
+
+if __name__ == "__main__":
+    test_write_layer()
@@ -0,0 +1,406 @@
+""" Block group origin-destination matrices of trips by time of day.
+
+Replaces the GROUP BY queries over trip_data
+
+    SELECT tod, day_of_week, start_bg_id, end_bg_id, COUNT(*), SUM(travel_time)
+    FROM trip_data GROUP BY tod, day_of_week, start_bg_id, end_bg_id;
+
+with one sparse matrix of trip counts and one of travel time sums (seconds)
+for each time of day and day of week, accumulated over batches of trips.
+
+The block groups are mapped to dense integer ids by a fixed zone index of
+12 digit GEOIDs, sorted so that the block groups of a county are consecutive
+and the trips from a county are a slice of rows of each CSR matrix. Row and
+column i of every matrix is zone i, so the attributes of a layer such as
+Austin_SocEco_BG can be joined by position with `zone_attributes`. Trips
+whose block groups are not zones are counted in `n_dropped`.
+
+The matrices are saved as .npy arrays that `ODMatrices.load` memory-maps,
+so that a slice reads only the rows it needs.
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from mylib.timefeatures import TOD_LABELS
+
+OD_COLUMNS = ["start_bg_id", "end_bg_id", "travel_time", "tod", "day_of_week"]
+
+MEASURES = ["trips", "travel_time"]
+
+_N_DAYS = 7
+
+def _geoids(bg_ids):
+    """ Takes the 12 digit GEOIDs of block group ids, which may be AFFGEOIDs. """
+
+    return pd.Series(np.asarray(bg_ids, dtype=object)).str[-12:]
+
+def zone_index(bg_ids):
+    """ Builds the sorted index of zones of a list of block groups.
+
+    Parameters
+    ----------
+    bg_ids : array-like of str
+        GEOIDs or AFFGEOIDs of the block groups, eg. the "GEOID" column of
+        Austin_SocEco_BG. Duplicates and missing values are ignored.
+
+    Returns
+    -------
+    pd.Index
+        Sorted, unique 12 digit GEOIDs.
+
+    """
+
+    geoids = _geoids(bg_ids).dropna().unique()
+    return pd.Index(np.sort(geoids.astype(str)), name="GEOID")
+
+def read_trip_batches(path, batch_size=1000000):
+    """ Reads the columns of trips used by `ODMatrices` from a Parquet file in batches.
+
+    Yields
+    ------
+    pd.DataFrame
+        Batch of at most `batch_size` trips with the `OD_COLUMNS`.
+
+    """
+
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=OD_COLUMNS):
+        yield batch.to_pandas()
+
+def _key_name(tod, day_of_week):
+    """ Name of the files of the matrices of a time of day and day of week. """
+
+    return "%s_%d" % (tod.lower().replace(" ", "_"), day_of_week)
+
+class ODMatrices:
+    """ Sparse origin-destination matrices by time of day and day of week.
+
+    Use `add` with each batch of trips, then `matrix` or `from_county` to
+    get the flows. The trips are buffered as coordinates and summed into
+    the CSR matrices every `buffer_size` trips, so that the memory used
+    depends on the number of distinct OD pairs rather than of trips.
+
+    Parameters
+    ----------
+    zones : array-like of str
+        Zones as returned by `zone_index`.
+    buffer_size : int, optional
+        Number of trips buffered before they are summed into the matrices.
+
+    """
+
+    def __init__(self, zones, buffer_size=5000000):
+        self.zones = pd.Index(zones, name="GEOID")
+        if not (self.zones.is_unique and self.zones.is_monotonic_increasing):
+            raise ValueError("The zones must be sorted and unique, as returned by zone_index.")
+        self.buffer_size = buffer_size
+        self.n_trips = 0
+        self.n_dropped = 0
+        # (tod, day_of_week) -> {measure: csr_matrix}
+        self._matrices = dict()
+        # (key code, origin, destination, seconds) arrays of the buffered trips
+        self._buffer = list()
+        self._n_buffered = 0
+
+    @property
+    def shape(self):
+        """ Shape of the matrices, zones by zones. """
+
+        return (len(self.zones), len(self.zones))
+
+    def add(self, trips):
+        """ Adds a batch of trips.
+
+        Parameters
+        ----------
+        trips : pd.DataFrame
+            Trips with the `OD_COLUMNS`, as returned by
+            `mylib.tripbuild.build_trips` or `read_trip_batches`.
+
+        Returns
+        -------
+        ODMatrices
+            This object.
+
+        """
+
+        origin = self.zones.get_indexer(_geoids(trips["start_bg_id"]))
+        destination = self.zones.get_indexer(_geoids(trips["end_bg_id"]))
+        tod = pd.Categorical(trips["tod"], categories=TOD_LABELS).codes.astype(np.int64)
+        day_of_week = pd.to_numeric(trips["day_of_week"]).to_numpy(dtype=float, na_value=np.nan)
+        seconds = pd.to_timedelta(trips["travel_time"]).dt.total_seconds().to_numpy(dtype=float, na_value=np.nan)
+
+        keep = ((origin >= 0) & (destination >= 0) & (tod >= 0) & (day_of_week >= 0) & (day_of_week < _N_DAYS) &
+                ~np.isnan(seconds))
+        key = tod[keep] * _N_DAYS + day_of_week[keep].astype(np.int64)
+        self._buffer.append((key, origin[keep], destination[keep], seconds[keep]))
+        self._n_buffered += len(key)
+        self.n_trips += len(key)
+        self.n_dropped += len(trips) - len(key)
+        if self._n_buffered >= self.buffer_size:
+            self._flush()
+        return self
+
+    def _flush(self):
+        """ Sums the buffered trips into the matrices. """
+
+        if self._n_buffered == 0:
+            self._buffer = list()
+            return
+        key, origin, destination, seconds = (np.concatenate(arrays) for arrays in zip(*self._buffer))
+        self._buffer = list()
+        self._n_buffered = 0
+
+        order = np.argsort(key, kind="stable")
+        codes, first = np.unique(key[order], return_index=True)
+        for code, rows in zip(codes, np.split(order, first[1:])):
+            values = {"trips": np.ones(len(rows), dtype=np.int64), "travel_time": seconds[rows]}
+            matrices = self._matrices.setdefault((TOD_LABELS[code // _N_DAYS], int(code % _N_DAYS)), dict())
+            for measure in MEASURES:
+                # Duplicate coordinates are summed when converting to CSR
+                added = scipy.sparse.csr_matrix((values[measure], (origin[rows], destination[rows])), shape=self.shape)
+                matrices[measure] = added if measure not in matrices else matrices[measure] + added
+
+    def keys(self):
+        """ Returns the (tod, day_of_week) pairs with trips. """
+
+        self._flush()
+        return sorted(self._matrices, key=lambda key: (TOD_LABELS.index(key[0]), key[1]))
+
+    def _sum(self, rows, tod, day_of_week, measure):
+        """ Sums the rows of the matrices of the selected keys. """
+
+        if measure not in MEASURES:
+            raise ValueError(f'Unknown measure "{measure}". Use "trips" or "travel_time".')
+        tods = TOD_LABELS if tod is None else [tod] if isinstance(tod, str) else list(tod)
+        days = range(_N_DAYS) if day_of_week is None else np.atleast_1d(day_of_week).tolist()
+        n_rows = len(range(*rows.indices(len(self.zones))))
+        total = scipy.sparse.csr_matrix((n_rows, len(self.zones)), dtype=np.int64 if measure == "trips" else np.float64)
+        for key in self.keys():
+            if key[0] in tods and key[1] in days:
+                total = total + self._matrices[key][measure][rows]
+        return total
+
+    def matrix(self, tod=None, day_of_week=None, measure="trips"):
+        """ Sums the matrices of some times of day and days of week.
+
+        Parameters
+        ----------
+        tod : str or list of str, optional
+            Times of day, all if None.
+        day_of_week : int or list of int, optional
+            Days of week, 0 is Sunday, all if None.
+        measure : str, optional
+            "trips" for the number of trips or "travel_time" for the sum of
+            their travel times in seconds.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            Zones of origin by zones of destination.
+
+        """
+
+        return self._sum(slice(None), tod, day_of_week, measure)
+
+    def county_rows(self, county):
+        """ Finds the rows of the zones of a county.
+
+        Parameters
+        ----------
+        county : str
+            State and county FIPS codes, eg. "48453" for Travis County.
+
+        Returns
+        -------
+        slice
+            Positions of the zones of the county.
+
+        """
+
+        # The GEOIDs are digits and ":" sorts right after "9", so the zones of
+        # the county are those from the county code up to the code with ":"
+        return slice(self.zones.searchsorted(county), self.zones.searchsorted(county + ":"))
+
+    def from_county(self, county, tod=None, day_of_week=None, measure="trips"):
+        """ Returns the flows from the zones of a county, as `matrix`.
+
+        Only the rows of the county are summed, so with memory-mapped
+        matrices only their data is read.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            Zones of origin in the county, in the order of `zones`, by all the
+            zones of destination.
+
+        """
+
+        return self._sum(self.county_rows(county), tod, day_of_week, measure)
+
+    def zone_attributes(self, layer, id_col="GEOID", columns=None):
+        """ Aligns the attributes of block groups with the zones.
+
+        Parameters
+        ----------
+        layer : pd.DataFrame
+            Block group attributes, eg. Austin_SocEco_BG read with
+            `mylib.layerio.read_layer`.
+        id_col : str, optional
+            Column with the GEOIDs or AFFGEOIDs of the block groups.
+        columns : list of str, optional
+            Columns to keep, all if None.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per zone, in the order of the rows and columns of the
+            matrices. Zones missing from `layer` have missing values.
+
+        """
+
+        attributes = layer if columns is None else layer[[id_col] + list(columns)]
+        attributes = attributes.set_index(pd.Index(_geoids(attributes[id_col]).to_numpy(), name="GEOID"))
+        return attributes.drop(columns=id_col).reindex(self.zones)
+
+    def save(self, folder):
+        """ Saves the zones and the matrices as .npy arrays in `folder`. """
+
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, "zones.npy"), self.zones.to_numpy(dtype=str))
+        keys = list()
+        for tod, day_of_week in self.keys():
+            name = _key_name(tod, day_of_week)
+            for measure, matrix in self._matrices[(tod, day_of_week)].items():
+                for part in ("data", "indices", "indptr"):
+                    np.save(os.path.join(folder, f"{name}_{measure}_{part}.npy"), getattr(matrix, part))
+            keys.append({"tod": tod, "day_of_week": day_of_week, "name": name})
+        with open(os.path.join(folder, "od_matrices.json"), "w") as manifest:
+            json.dump({"n_trips": self.n_trips, "n_dropped": self.n_dropped, "keys": keys}, manifest, indent=1)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """ Loads the matrices saved with `save`, memory-mapped unless `mmap` is False.
+
+        Trips can still be added to loaded matrices; the sums are then held
+        in memory.
+
+        """
+
+        mmap_mode = "r" if mmap else None
+        od_matrices = cls(np.load(os.path.join(folder, "zones.npy")).astype(object))
+        with open(os.path.join(folder, "od_matrices.json")) as manifest:
+            manifest = json.load(manifest)
+        od_matrices.n_trips = manifest["n_trips"]
+        od_matrices.n_dropped = manifest["n_dropped"]
+        for key in manifest["keys"]:
+            matrices = od_matrices._matrices.setdefault((key["tod"], key["day_of_week"]), dict())
+            for measure in MEASURES:
+                parts = [np.load(os.path.join(folder, f"{key['name']}_{measure}_{part}.npy"), mmap_mode=mmap_mode)
+                         for part in ("data", "indices", "indptr")]
+                matrices[measure] = scipy.sparse.csr_matrix(tuple(parts), shape=od_matrices.shape, copy=False)
+        return od_matrices
+
+def build_od_matrices(paths, zones, batch_size=1000000, buffer_size=5000000):
+    """ Builds the OD matrices of the trips of Parquet files, one batch at a time.
+
+    Parameters
+    ----------
+    paths : list of str
+        Parquet files of trips, as written from `mylib.tripbuild.build_trips`.
+    zones : array-like of str
+        Zones as returned by `zone_index`.
+    batch_size, buffer_size : int, optional
+        Trips read at a time, and buffered before they are summed.
+
+    Returns
+    -------
+    ODMatrices
+        Matrices of all the trips.
+
+    """
+
+    od_matrices = ODMatrices(zones, buffer_size=buffer_size)
+    for path in paths:
+        for trips in read_trip_batches(path, batch_size=batch_size):
+            od_matrices.add(trips)
+    return od_matrices
+
+def test_od_matrices():
+    """ Tests the OD matrices against a groupby of the trips. """
+
+    import tempfile
+
+    print("Testing ODMatrices.")
+    rng = np.random.default_rng(0)
+    geoids = np.array(["48453%06d%d" % (tract, 1 + tract % 3) for tract in range(1000, 1012)] +
+                      ["48491%06d%d" % (tract, 1 + tract % 3) for tract in range(2000, 2008)])
+    zones = zone_index(np.concatenate([geoids, geoids[:3], [None]]))
+    assert list(zones) == sorted(geoids)
+
+    n_trips = 2000
+    # Some of the trips are from AFFGEOIDs, and some from or to block groups
+    # that are not zones, or at unknown times
+    start_bg_id = rng.choice(np.concatenate([geoids, ["1500000US" + geoids[0], "480010001001"]]), n_trips)
+    end_bg_id = rng.choice(np.concatenate([geoids, ["480010001001"]]), n_trips)
+    trips = pd.DataFrame({"start_bg_id": start_bg_id, "end_bg_id": end_bg_id,
+                          "travel_time": pd.to_timedelta(rng.integers(60, 3600, n_trips), unit="s"),
+                          "tod": rng.choice(TOD_LABELS + [None], n_trips),
+                          "day_of_week": rng.integers(0, _N_DAYS, n_trips)})
+
+    # Expected counts and travel times of the trips between zones
+    expected = trips.assign(start_bg_id=trips["start_bg_id"].str[-12:], seconds=trips["travel_time"].dt.total_seconds())
+    expected = expected.loc[expected["start_bg_id"].isin(zones) & expected["end_bg_id"].isin(zones) & expected["tod"].notna()]
+    expected = expected.groupby(["tod", "day_of_week", "start_bg_id", "end_bg_id"])["seconds"].agg(["size", "sum"])
+
+    def assert_matches(od_matrices, trips_expected):
+        assert od_matrices.n_trips == trips_expected["size"].sum()
+        assert od_matrices.n_trips + od_matrices.n_dropped == n_trips
+        for (tod, day_of_week), flows in trips_expected.groupby(level=["tod", "day_of_week"]):
+            flows = flows.droplevel(["tod", "day_of_week"])
+            origin = zones.get_indexer(flows.index.get_level_values("start_bg_id"))
+            destination = zones.get_indexer(flows.index.get_level_values("end_bg_id"))
+            for measure, column in (("trips", "size"), ("travel_time", "sum")):
+                dense = np.zeros(od_matrices.shape)
+                dense[origin, destination] = flows[column]
+                assert np.allclose(od_matrices.matrix(tod, day_of_week, measure).toarray(), dense)
+        assert od_matrices.matrix().sum() == od_matrices.n_trips
+        assert np.isclose(od_matrices.matrix(measure="travel_time").sum(), trips_expected["sum"].sum())
+
+    # Summed at once, and in batches that fill the buffer several times
+    od_matrices = ODMatrices(zones).add(trips)
+    assert_matches(od_matrices, expected)
+    batched = ODMatrices(zones, buffer_size=150)
+    for start in range(0, n_trips, 110):
+        batched.add(trips.iloc[start:start + 110])
+    assert batched.keys() == od_matrices.keys()
+    assert_matches(batched, expected)
+
+    # Memory-mapped matrices read back from disk are the same
+    with tempfile.TemporaryDirectory() as folder:
+        od_matrices.save(folder)
+        loaded = ODMatrices.load(folder, mmap=True)
+        # The arrays are read-only views of the memory-mapped files
+        assert not any(matrix.data.flags.writeable or matrix.indices.flags.writeable
+                       for matrices in loaded._matrices.values() for matrix in matrices.values())
+        assert list(loaded.zones) == list(zones) and loaded.keys() == od_matrices.keys()
+        assert loaded.n_trips == od_matrices.n_trips and loaded.n_dropped == od_matrices.n_dropped
+        assert_matches(loaded, expected)
+
+        # The flows from a county are exactly the rows of its zones
+        for county, n_zones in (("48453", 12), ("48491", 8), ("48001", 0)):
+            rows = loaded.county_rows(county)
+            assert list(zones[rows]) == sorted(geoid for geoid in geoids if geoid.startswith(county))
+            assert len(zones[rows]) == n_zones
+            for measure in MEASURES:
+                flows = loaded.from_county(county, "AM Peak", [1, 2], measure)
+                assert flows.shape == (n_zones, len(zones))
+                assert np.allclose(flows.toarray(), od_matrices.matrix("AM Peak", [1, 2], measure).toarray()[rows])
+
+if __name__ == "__main__":
+    test_od_matrices()
@@ -0,0 +1,332 @@
+""" Stage-level timing and memory instrumentation of pipeline runs.
+
+A `RunReport` records, for each stage of a run, the wall time, the CPU time
+of the process, the resident memory (RSS) at the end of the stage and its
+peak so far, the peak of the memory traced by tracemalloc (opt-in, as it
+slows the run down) and the number of rows produced. Stages are marked with
+the `stage` context manager or the `instrumented` decorator, which do
+nothing when no report is running, and can be nested. The report is saved
+as JSON, and the reports of several runs can be compared with
+`load_reports`. The whole run can also be profiled with cProfile.
+
+The library modules of mylib do not import this one, so the calls to them
+are marked as stages by the scripts that make them.
+
+    with RunReport("compile", report_path="run.json") as report:
+        with stage("read") as record:
+            layer = read_layer(path)
+            record["rows"] = len(layer)
+        with stage("layerfuse"):
+            fused = layerfuse(layer, ...)
+
+The CPU time and the memory are those of the calling process only; the work
+done in worker processes is not included.
+"""
+
+import cProfile
+import contextlib
+import datetime
+import functools
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import pandas as pd
+
+_MB = 1024 ** 2
+
+# The report that the stages are recorded in, if a run is in progress
+_ACTIVE_REPORT = None
+
+def _rss():
+    """ Returns the current and peak resident memory of the process in MB.
+
+    The current RSS is read with psutil, or from /proc on Linux without it,
+    and is None otherwise. The peak is the high-water mark of the process
+    since it started.
+
+    """
+
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    rss = None
+    peak = None
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        rss = memory.rss / _MB
+        if hasattr(memory, "peak_wset"): # Windows
+            peak = memory.peak_wset / _MB
+    elif os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / _MB
+    if peak is None:
+        try:
+            import resource
+        except ImportError: # Windows without psutil
+            return rss, None
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kB elsewhere
+        peak = max_rss / _MB if sys.platform == "darwin" else max_rss / 1024
+    return rss, peak
+
+def _rows(result):
+    """ Number of rows of a DataFrame or array, None for other results. """
+
+    shape = getattr(result, "shape", None)
+    return int(shape[0]) if shape else None
+
+class RunReport:
+    """ Timings and memory use of the stages of a run.
+
+    Use it as a context manager, or call `start` and `finish`.
+
+    Parameters
+    ----------
+    name : str
+        Name of the run, eg. the script.
+    report_path : str, optional
+        JSON file where the report is saved by `finish`.
+    trace_memory : bool, optional
+        Whether to trace the memory allocated by Python with tracemalloc,
+        to report the peak of each stage.
+    profile_path : str, optional
+        If given, the run is profiled with cProfile and the statistics are
+        dumped in this file, to be read with `pstats` or snakeviz.
+    parameters : dict, optional
+        Parameters of the run saved in the report, eg. the region or the
+        data sizes, to compare runs with.
+
+    """
+
+    def __init__(self, name, report_path=None, trace_memory=False, profile_path=None, parameters=None):
+        self.name = name
+        self.report_path = report_path
+        self.trace_memory = trace_memory
+        self.profile_path = profile_path
+        self.parameters = dict() if parameters is None else dict(parameters)
+        self.stages = list()
+        self.summary = dict()
+        # Names and running tracemalloc peaks of the stages in progress
+        self._stack = list()
+        self._profiler = None
+        self._started_tracing = False
+        # Record of the innermost stage that raised an exception, if any
+        self._failed = None
+
+    def start(self):
+        """ Starts recording the stages of the run. """
+
+        global _ACTIVE_REPORT
+        _ACTIVE_REPORT = self
+        self._started_at = datetime.datetime.now().isoformat(timespec="seconds")
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if self.profile_path is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def finish(self, report_path=None):
+        """ Stops recording, saves the report and returns it as a dict.
+
+        If a stage raised an exception, the report is still saved, with the
+        name of that stage and the error in its summary.
+
+        """
+
+        global _ACTIVE_REPORT
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        if self._profiler is not None:
+            self._profiler.disable()
+            os.makedirs(os.path.dirname(self.profile_path) or ".", exist_ok=True)
+            self._profiler.dump_stats(self.profile_path)
+            self._profiler = None
+        rss, peak_rss = _rss()
+        self.summary = {"wall_s": wall, "cpu_s": cpu, "rss_mb": rss, "peak_rss_mb": peak_rss}
+        if self._failed is not None:
+            self.summary["failed_stage"] = self._failed["stage"]
+            self.summary["error"] = self._failed["error"]
+        if self.trace_memory:
+            self.summary["traced_peak_mb"] = max([stage["traced_peak_mb"] for stage in self.stages] +
+                                                 [tracemalloc.get_traced_memory()[1] / _MB])
+            # Tracing started before the run is left running
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        if _ACTIVE_REPORT is self:
+            _ACTIVE_REPORT = None
+
+        report = self.to_dict()
+        report_path = report_path or self.report_path
+        if report_path is not None:
+            os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+            with open(report_path, "w") as report_file:
+                json.dump(report, report_file, indent=1)
+        return report
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        """ Records a stage of the run, see `stage`. """
+
+        record = {"stage": "/".join([parent for parent, _ in self._stack] + [name]), "rows": rows}
+        if self.trace_memory:
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append([name, 0])
+        started = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        except BaseException as error:
+            record["error"] = f"{type(error).__name__}: {error}"
+            if self._failed is None:
+                self._failed = record
+            raise
+        finally:
+            record["start_s"] = started - self._wall
+            record["wall_s"] = time.perf_counter() - started
+            record["cpu_s"] = time.process_time() - cpu
+            record["rss_mb"], record["peak_rss_mb"] = _rss()
+            _, traced_peak = self._stack.pop()
+            if self.trace_memory:
+                # The peak of a stage includes the peaks of its nested stages
+                traced_peak = max(traced_peak, tracemalloc.get_traced_memory()[1])
+                record["traced_peak_mb"] = traced_peak / _MB
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], traced_peak)
+            self.stages.append(record)
+
+    def to_dict(self):
+        """ Returns the report with the stages in the order they started. """
+
+        return {"name": self.name, "started_at": getattr(self, "_started_at", None),
+                "python": platform.python_version(), "platform": platform.platform(),
+                "parameters": self.parameters, "summary": self.summary,
+                "stages": sorted(self.stages, key=lambda record: record["start_s"])}
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+    """ Records a stage in the running report, if any.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage. Nested stages are named "parent/child".
+    rows : int, optional
+        Number of rows of the stage. It can also be set in the yielded
+        record, as `record["rows"] = len(result)`.
+
+    Yields
+    ------
+    dict
+        Record of the stage, filled in when the stage ends.
+
+    """
+
+    if _ACTIVE_REPORT is None:
+        yield {"stage": name, "rows": rows}
+    else:
+        with _ACTIVE_REPORT.stage(name, rows) as record:
+            yield record
+
+def instrumented(name=None):
+    """ Decorates a function to record each call as a stage.
+
+    The stage is named after the function unless `name` is given. If the
+    function returns a DataFrame or an array, its number of rows is
+    recorded.
+
+    """
+
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _ACTIVE_REPORT is None:
+                return function(*args, **kwargs)
+            with _ACTIVE_REPORT.stage(stage_name) as record:
+                result = function(*args, **kwargs)
+                record["rows"] = _rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+def measure(function, *args, **kwargs):
+    """ Runs `function` and returns its result, wall time and peak traced memory.
+
+    Used by the benchmarks. tracemalloc slows down allocation heavy code
+    unevenly, so the call is timed in a run without tracing and the peak
+    memory is taken from a second, traced run. If tracemalloc is already
+    running, eg. in a report with `trace_memory`, it is left running and
+    the call is run once, timed while traced.
+
+    Returns
+    -------
+    tuple
+        Result of the timed run, wall time in seconds and peak memory
+        allocated by the call in bytes.
+
+    """
+
+    traced = tracemalloc.is_tracing()
+    if traced:
+        # Keeping the peak of the running stage, as a nested stage does
+        if _ACTIVE_REPORT is not None and _ACTIVE_REPORT._stack:
+            running = _ACTIVE_REPORT._stack[-1]
+            running[1] = max(running[1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    if not traced:
+        tracemalloc.start()
+        before = 0
+        try:
+            function(*args, **kwargs)
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    else:
+        _, peak = tracemalloc.get_traced_memory()
+    return result, elapsed, peak - before
+
+def load_reports(paths):
+    """ Loads the stages of saved reports into one table to compare runs.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per stage of each report, with the name, start time and
+        parameters of its run, eg. to pivot the wall time by stage and run.
+
+    """
+
+    records = list()
+    for path in paths:
+        with open(path) as report_file:
+            report = json.load(report_file)
+        run = {"run": report["name"], "started_at": report["started_at"], "report": path}
+        run.update({"param_" + key: value for key, value in report["parameters"].items()})
+        records.extend(dict(run, **record) for record in report["stages"])
+        records.append(dict(run, stage="total", **report["summary"]))
+    return pd.DataFrame(records)
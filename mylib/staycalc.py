@@ -0,0 +1,91 @@
+""" Stays of vehicles between consecutive trips.
+
+Computes the columns that SQL_Commands.sql adds to trip_data with LEAD
+window functions, UPDATEs and the plpgsql functions seconds_from_midnight
+and get_day_end, in one pass over the trips sorted by device:
+
+    next_start_longitude, next_start_latitude, next_bg_id, next_start_time
+        Start of the next trip of the same device.
+    stay_indicator
+        Whether the next trip starts in the block group where the trip
+        ends. Missing if either block group is missing or if the stay
+        lasts 15 days or more.
+    stay_duration
+        Time until the next trip, only for stays with a true indicator
+        and a duration between 0 and 15 days.
+    overnight_stay
+        Whether the stay covers the next 3 AM after the end of the trip,
+        only for stays with a duration.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+# Stays this long or longer must span a gap in the data
+STAY_LIMIT = pd.Timedelta(days=15)
+
+_DAY_END = pd.Timedelta(hours=3)
+# get_day_end rounds the time of day to whole seconds before comparing it
+# with 3 AM, so times before 3:00:00.5 belong to the same day
+_DAY_END_CUTOFF = _DAY_END + pd.Timedelta(milliseconds=500)
+
+_NEXT_COLUMNS = {"start_longitude": "next_start_longitude", "start_latitude": "next_start_latitude",
+                 "start_bg_id": "next_bg_id", "start_time": "next_start_time"}
+
+def _day_end(time):
+    """ Finds the first 3 AM at or after each time, as get_day_end. """
+
+    day = time.dt.normalize()
+    return day + pd.to_timedelta(np.where((time - day) < _DAY_END_CUTOFF, _DAY_END, _DAY_END + pd.Timedelta(days=1)))
+
+def _stays(trips):
+    """ Computes the stay columns of trips of whole devices. """
+
+    trips = trips.sort_values(["device_id", "start_time"], kind="stable").reset_index(drop=True)
+    device = trips["device_id"].to_numpy()
+    has_next = pd.Series(np.append(device[1:] == device[:-1], False), index=trips.index)
+    for column, next_column in _NEXT_COLUMNS.items():
+        trips[next_column] = trips[column].shift(-1).where(has_next)
+
+    stay_duration = trips["next_start_time"] - trips["end_time"]
+    same_bg = pd.Series((trips["end_bg_id"] == trips["next_bg_id"]).to_numpy(), index=trips.index, dtype="boolean")
+    known = trips["end_bg_id"].notna() & trips["next_bg_id"].notna() & (stay_duration < STAY_LIMIT)
+    trips["stay_indicator"] = same_bg.where(known)
+    trips["stay_duration"] = stay_duration.where(trips["stay_indicator"].fillna(False) &
+                                                 (stay_duration >= pd.Timedelta(0)))
+    overnight = pd.Series((trips["next_start_time"] > _day_end(trips["end_time"])).to_numpy(), index=trips.index,
+                          dtype="boolean")
+    trips["overnight_stay"] = overnight.where(trips["stay_duration"].notna())
+    return trips
+
+def compute_stays(trips, n_jobs=1):
+    """ Adds the stay columns to trips.
+
+    Parameters
+    ----------
+    trips : pd.DataFrame
+        Trips as returned by `mylib.tripbuild.build_trips`.
+    n_jobs : int, optional
+        Number of processes. The devices are split into this many shards by
+        a hash of their id, and the shards are computed in parallel. None
+        uses all the CPUs. On Windows, the calling script should be guarded
+        with `if __name__ == "__main__":`.
+
+    Returns
+    -------
+    pd.DataFrame
+        The trips sorted by device and start time, with the stay columns.
+
+    """
+
+    n_jobs = n_jobs or os.cpu_count()
+    if n_jobs == 1 or len(trips) == 0:
+        return _stays(trips)
+
+    shard = pd.util.hash_array(trips["device_id"].to_numpy()) % n_jobs
+    shards = [trips.loc[shard == i] for i in range(n_jobs)]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        trips = pd.concat(list(executor.map(_stays, shards)), ignore_index=True)
+    return trips.sort_values(["device_id", "start_time"], kind="stable").reset_index(drop=True)
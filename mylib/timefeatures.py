@@ -0,0 +1,122 @@
+""" Local time and time of day features of connected-vehicle events.
+
+Computes, in one vectorized pass, the columns that SQL_Commands.sql fills
+with separate UPDATEs:
+
+    captured_time     to_timestamp(capturedTimestamp / 1000)
+    local_time        timezone('America/Chicago', captured_time)
+    local_day_hour    second / 3600 + minute / 60 + hour of local_time
+    tod               time of day bucket of local_day_hour
+    day_of_week       EXTRACT(dow from local_time), 0 is Sunday
+
+The time of day buckets are found from the integer milliseconds since local
+midnight, so that events exactly on a bucket edge fall in the same bucket
+as in the SQL, which compares exact numerics.
+"""
+
+import numpy as np
+import pandas as pd
+
+TIMEZONE = "America/Chicago"
+
+# Upper edges of the time of day buckets in hours, as in the SQL CASE. Hours
+# before the first edge and from the last edge on are 'Night'.
+TOD_EDGES = [6.5, 9.0, 12.0, 15.0, 19.0]
+TOD_LABELS = ['Night', 'AM Peak', 'Midday 1', 'Midday 2', 'PM Peak']
+
+_MS_PER_HOUR = 3600000
+
+def time_features(captured_timestamp, timezone=TIMEZONE):
+    """ Derives the time features of events from their epoch timestamps.
+
+    Parameters
+    ----------
+    captured_timestamp : array-like of int
+        Time of the events in milliseconds since the epoch (UTC). Missing
+        values give missing features.
+    timezone : str, optional
+        Time zone of the local time.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns "captured_time" (UTC), "local_time" (without time zone, as
+        the SQL timestamp), "local_day_hour", "tod" and "day_of_week", with
+        the index of `captured_timestamp` if it is a Series.
+
+    """
+
+    index = captured_timestamp.index if isinstance(captured_timestamp, pd.Series) else None
+    timestamp = pd.array(captured_timestamp, dtype="Int64")
+    captured_time = np.where(timestamp.isna(), np.datetime64("NaT", "ms"),
+                             timestamp.to_numpy(dtype=np.int64, na_value=0).astype("datetime64[ms]"))
+    captured_time = pd.Series(captured_time, index=index).dt.tz_localize("UTC")
+    local_time = captured_time.dt.tz_convert(timezone).dt.tz_localize(None)
+
+    ms_of_day = ((local_time - local_time.dt.normalize()) // pd.Timedelta(milliseconds=1)).to_numpy(dtype=float, na_value=np.nan)
+    edges = [edge * _MS_PER_HOUR for edge in TOD_EDGES]
+    tod = np.select([ms_of_day < edges[0], ms_of_day < edges[1], ms_of_day < edges[2], ms_of_day < edges[3],
+                     ms_of_day < edges[4], ms_of_day < 24 * _MS_PER_HOUR],
+                    ['Night', 'AM Peak', 'Midday 1', 'Midday 2', 'PM Peak', 'Night'], default=None)
+
+    return pd.DataFrame({"captured_time": captured_time,
+                         "local_time": local_time,
+                         "local_day_hour": ms_of_day / _MS_PER_HOUR,
+                         "tod": pd.Categorical(tod, categories=TOD_LABELS),
+                         "day_of_week": ((local_time.dt.dayofweek + 1) % 7).astype("Int8")}, index=index)
+
+def add_time_features(events, timestamp_col="captured_timestamp", timezone=TIMEZONE):
+    """ Adds the columns of `time_features` to a batch of events.
+
+    Meant to be applied to each batch of `mylib.eventstream.iter_event_batches`
+    so that the features are computed at ingestion.
+
+    """
+
+    features = time_features(events[timestamp_col], timezone=timezone)
+    events = events.copy()
+    for column in features.columns:
+        events[column] = features[column]
+    return events
+
+def test_time_features():
+    """ Tests the time features against the CASE of SQL_Commands.sql. """
+
+    print("Testing time_features.")
+    # Local time with its UTC offset, and the local time, day hour, time of
+    # day and day of week set by the SQL. 2020-03-02 is a Monday and the
+    # clocks went from 2:00 CST to 3:00 CDT on Sunday 2020-03-08.
+    cases = [("2020-03-02T00:00:00-06:00", "2020-03-02 00:00:00", 0.0, "Night", 1),
+             ("2020-03-02T06:29:59.999-06:00", "2020-03-02 06:29:59.999", 6.5 - 1 / 3600000, "Night", 1),
+             ("2020-03-02T06:30:00-06:00", "2020-03-02 06:30:00", 6.5, "AM Peak", 1),
+             ("2020-03-02T08:59:59.999-06:00", "2020-03-02 08:59:59.999", 9 - 1 / 3600000, "AM Peak", 1),
+             ("2020-03-02T09:00:00-06:00", "2020-03-02 09:00:00", 9.0, "Midday 1", 1),
+             ("2020-03-02T12:00:00-06:00", "2020-03-02 12:00:00", 12.0, "Midday 2", 1),
+             ("2020-03-02T15:00:00-06:00", "2020-03-02 15:00:00", 15.0, "PM Peak", 1),
+             ("2020-03-02T18:59:59.999-06:00", "2020-03-02 18:59:59.999", 19 - 1 / 3600000, "PM Peak", 1),
+             ("2020-03-02T19:00:00-06:00", "2020-03-02 19:00:00", 19.0, "Night", 1),
+             ("2020-03-02T23:59:59.999-06:00", "2020-03-02 23:59:59.999", 24 - 1 / 3600000, "Night", 1),
+             ("2020-03-07T06:30:00-06:00", "2020-03-07 06:30:00", 6.5, "AM Peak", 6),
+             ("2020-03-08T01:59:59.999-06:00", "2020-03-08 01:59:59.999", 2 - 1 / 3600000, "Night", 0),
+             ("2020-03-08T03:00:00-05:00", "2020-03-08 03:00:00", 3.0, "Night", 0),
+             ("2020-03-08T06:30:00-05:00", "2020-03-08 06:30:00", 6.5, "AM Peak", 0),
+             ("2020-03-08T19:00:00-05:00", "2020-03-08 19:00:00", 19.0, "Night", 0),
+             ("2020-03-09T00:00:00-05:00", "2020-03-09 00:00:00", 0.0, "Night", 1)]
+    captured_timestamp = pd.Series([pd.Timestamp(case[0]).value // 1000000 for case in cases] + [None],
+                                   index=range(10, 10 + len(cases) + 1), dtype="Int64")
+    features = time_features(captured_timestamp)
+    assert features.index.equals(captured_timestamp.index)
+
+    known = features.iloc[:-1]
+    assert known["local_time"].tolist() == [pd.Timestamp(case[1]) for case in cases]
+    assert np.allclose(known["local_day_hour"], [case[2] for case in cases], rtol=0, atol=1e-12)
+    assert known["tod"].tolist() == [case[3] for case in cases]
+    assert known["day_of_week"].tolist() == [case[4] for case in cases]
+
+    # A missing timestamp gives missing features
+    missing = features.iloc[-1]
+    assert pd.isna(missing["captured_time"]) and pd.isna(missing["local_time"]) and np.isnan(missing["local_day_hour"])
+    assert pd.isna(missing["tod"]) and pd.isna(missing["day_of_week"])
+
+if __name__ == "__main__":
+    test_time_features()
@@ -0,0 +1,116 @@
+""" Pairing of journey START and END events into trips.
+
+Builds the final trip_data table of SQL_Commands.sql without the self-join
+of journey_data and the intermediate tables. Each START is matched with the
+END of the same device and journey whose time is nearest to the START plus
+30 minutes, with sorted as-of merges, and the heuristics of the SQL are then
+applied in order:
+
+1. Each journey keeps the trip with the travel time closest to 30 minutes,
+   the earliest starting one if several are as close.
+2. Trips of a device with the same start and end locations and times keep
+   the one with the lowest journey_id.
+3. Trips of a device with the same start time keep the one with the travel
+   time closest to 30 minutes.
+
+Ties that the SQL leaves to the database are broken here by the earliest
+end time and then the lowest journey_id.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Travel time that the heuristics of the SQL prefer
+TRIP_TARGET = pd.Timedelta(minutes=30)
+
+# Local time periods of the events used, [start, end)
+JOURNEY_PERIODS = [("2020-03-02", "2020-03-07"), ("2020-04-06", "2020-04-11")]
+
+JOURNEY_COLUMNS = ["longitude", "latitude", "bg_id", "local_time", "local_day_hour", "tod", "day_of_week",
+                   "device_id", "journey_id", "journey_event", "zip_code"]
+
+TRIP_COLUMNS = ["start_longitude", "start_latitude", "end_longitude", "end_latitude", "start_bg_id", "end_bg_id",
+                "start_time", "end_time", "travel_time", "tod", "day_of_week", "device_id", "journey_id"]
+
+def journey_events(events, periods=JOURNEY_PERIODS):
+    """ Selects the distinct journey events in the periods, as journey_data.
+
+    Parameters
+    ----------
+    events : pd.DataFrame
+        Events with the columns of `mylib.eventstream`, the features of
+        `mylib.timefeatures` and a "bg_id" column.
+    periods : list of tuple, optional
+        Periods of local time to keep, each as (start, end) with the end
+        excluded.
+
+    Returns
+    -------
+    pd.DataFrame
+        Distinct rows of the `JOURNEY_COLUMNS` of the journey events.
+
+    """
+
+    in_period = np.zeros(len(events), dtype=bool)
+    for start, end in periods:
+        in_period |= ((events["local_time"] >= pd.Timestamp(start)) & (events["local_time"] < pd.Timestamp(end))).to_numpy()
+    is_journey = (events["event_type"] == "JOURNEY").to_numpy(dtype=bool)
+    return events.loc[is_journey & in_period, JOURNEY_COLUMNS].drop_duplicates().reset_index(drop=True)
+
+def _journey_ends(journeys, event, prefix, columns):
+    """ Selects the START or END events with their columns renamed with `prefix`. """
+
+    ends = journeys.loc[journeys["journey_event"] == event, ["device_id", "journey_id", "local_time"] + columns]
+    ends = ends.dropna(subset=["device_id", "journey_id", "local_time"])
+    return ends.rename(columns={column: prefix + column for column in ["local_time"] + columns})
+
+def build_trips(journeys, target=TRIP_TARGET):
+    """ Pairs the START and END events of journeys into trips.
+
+    Parameters
+    ----------
+    journeys : pd.DataFrame
+        Journey events, as returned by `journey_events`.
+    target : pd.Timedelta, optional
+        Preferred travel time of the heuristics.
+
+    Returns
+    -------
+    pd.DataFrame
+        One trip per row with the `TRIP_COLUMNS`, sorted by device and start
+        time. The time of day and day of week are those of the start.
+
+    """
+
+    location_cols = ["longitude", "latitude", "bg_id"]
+    starts = _journey_ends(journeys, "START", "start_", location_cols + ["tod", "day_of_week"])
+    starts = starts.rename(columns={"start_tod": "tod", "start_day_of_week": "day_of_week"})
+    ends = _journey_ends(journeys, "END", "end_", location_cols)
+    # merge_asof needs keys of the same resolution, which adding the target
+    # may change, so both are matched in nanoseconds
+    starts["target_time"] = (starts["start_local_time"] + target).astype("datetime64[ns]")
+    ends["end_key"] = ends["end_local_time"].astype("datetime64[ns]")
+    starts = starts.sort_values("target_time", kind="stable")
+    ends = ends.sort_values("end_key", kind="stable")
+
+    # Only the ENDs just before and just after the target time can be the
+    # nearest to it
+    candidates = list()
+    for direction in ("backward", "forward"):
+        paired = pd.merge_asof(starts, ends, left_on="target_time", right_on="end_key",
+                               by=["device_id", "journey_id"], direction=direction)
+        candidates.append(paired.loc[paired["end_local_time"] > paired["start_local_time"]])
+    trips = pd.concat(candidates, ignore_index=True)
+    trips = trips.rename(columns={"start_local_time": "start_time", "end_local_time": "end_time"})
+    trips["travel_time"] = trips["end_time"] - trips["start_time"]
+    trips["target_diff"] = (trips["travel_time"] - target).abs()
+
+    trips = trips.sort_values(["journey_id", "target_diff", "start_time", "end_time"], kind="stable")
+    trips = trips.drop_duplicates("journey_id")
+    trips = trips.sort_values("journey_id", kind="stable")
+    trips = trips.drop_duplicates(["device_id", "start_longitude", "start_latitude", "end_longitude", "end_latitude",
+                                   "start_time", "end_time"])
+    trips = trips.sort_values(["target_diff", "journey_id"], kind="stable")
+    trips = trips.drop_duplicates(["device_id", "start_time"])
+
+    return trips.sort_values(["device_id", "start_time"], kind="stable")[TRIP_COLUMNS].reset_index(drop=True)